@@ -2,11 +2,36 @@ import discord
 from discord import app_commands
 from discord.ext import commands, tasks
 import sqlite3
+import math
 import asyncio
+import heapq
+import itertools
+import bisect
+import re
+import random
+import statistics
+import time
+import signal
+import socket
+import threading
+import gc
+import tracemalloc
+from array import array
 from datetime import datetime, timedelta
 import os
+import sys
+import csv
+import tempfile
+import argparse
+from collections import deque, namedtuple
 from dotenv import load_dotenv
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # 可选依赖：仅导出 parquet 时需要
+    pyarrow = None
+
 # 加载环境变量
 load_dotenv()
 
@@ -14,13 +39,159 @@ load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
 GUILD_ID = int(os.getenv('GUILD_ID', 0))
 VIP_ROLE_ID = int(os.getenv('VIP_ROLE_ID', 0))
-EXPERIENCE_DURATION_HOURS = 0.01  # 体验时长2小时
+EXPERIENCE_DURATION_HOURS = float(os.getenv('EXPERIENCE_DURATION_HOURS', 2))  # 体验时长2小时
+TRIAL_CAPACITY = int(os.getenv('TRIAL_CAPACITY', 0))  # 同时进行的体验人数上限，0 表示不限
+# 成员缓存策略：selective 只缓存相关成员，full 使用 discord.py 默认的全量缓存
+MEMBER_CACHE_POLICY = os.getenv('MEMBER_CACHE_POLICY', 'selective')
+# 设置为 1 时由独立的 expire-worker 进程执行撤销，机器人本身不再定时处理
+EXTERNAL_EXPIRY_WORKER = os.getenv('EXTERNAL_EXPIRY_WORKER', '0') == '1'
+DB_PATH = 'vip_experience.db'
+
+# 可选的 SQL 语句跟踪回调（模拟器用来统计数据库读写次数）
+_db_trace = None
+
+# 获取数据库连接
+def get_db():
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    if _db_trace is not None:
+        conn.set_trace_callback(_db_trace)
+    return conn
+
+# ========== 时钟 ==========
+
+# 所有与到期相关的"当前时间"都通过 clock.now() 获取，模拟器替换为虚拟时钟后可以快进时间
+class SystemClock:
+    def now(self):
+        return datetime.now()
+
+class SimulatedClock:
+    def __init__(self, start):
+        self.current = start
+
+    def now(self):
+        return self.current
+
+    def advance(self, delta):
+        self.current += delta
+
+clock = SystemClock()
+
+# ========== 运行时配置 ==========
+
+# 配置快照：只读，修改时整体替换，热路径直接读取 CONFIG 无需加锁
+ConfigSnapshot = namedtuple('ConfigSnapshot', ['guild_id', 'vip_role_id', 'experience_duration_hours', 'trial_capacity'])
+
+# 可在运行时修改的配置项：名称 -> (类型, 说明)
+CONFIG_FIELDS = {
+    'guild_id': (int, '服务器 ID'),
+    'vip_role_id': (int, '会员身份组 ID'),
+    'experience_duration_hours': (float, '体验时长（小时）'),
+    'trial_capacity': (int, '体验名额上限（0 为不限）'),
+}
+# 允许设为 0 的配置项
+CONFIG_ALLOW_ZERO = {'trial_capacity'}
+# 配置项的上限（ID 不超过 SQLite 整数范围，体验时长不超过一年）
+CONFIG_MAX = {
+    'guild_id': 2**63 - 1,
+    'vip_role_id': 2**63 - 1,
+    'experience_duration_hours': 8760,
+    'trial_capacity': 1000000,
+}
+
+# 环境变量中的值作为默认配置，数据库中的配置优先
+CONFIG_DEFAULTS = ConfigSnapshot(
+    guild_id=GUILD_ID,
+    vip_role_id=VIP_ROLE_ID,
+    experience_duration_hours=EXPERIENCE_DURATION_HOURS,
+    trial_capacity=TRIAL_CAPACITY,
+)
+CONFIG = CONFIG_DEFAULTS
+
+# 解析并校验配置值
+def parse_config_value(key, value):
+    if key not in CONFIG_FIELDS:
+        raise ValueError(f'未知的配置项：{key}')
+    try:
+        parsed = CONFIG_FIELDS[key][0](value)
+    except (TypeError, ValueError):
+        raise ValueError(f'配置项 {key} 的值无效：{value}')
+    if not math.isfinite(parsed):
+        raise ValueError(f'配置项 {key} 的值无效：{value}')
+    if parsed < 0 or (parsed == 0 and key not in CONFIG_ALLOW_ZERO):
+        raise ValueError(f'配置项 {key} 必须大于0')
+    if parsed > CONFIG_MAX[key]:
+        raise ValueError(f'配置项 {key} 不能大于 {CONFIG_MAX[key]}')
+    return parsed
+
+# 校验整个配置快照能被实际使用（按体验时长计算到期时间不会溢出）
+def validate_config(snapshot):
+    try:
+        duration = timedelta(hours=snapshot.experience_duration_hours)
+        clock.now() + duration
+        clock.now() - duration
+    except (ValueError, OverflowError) as e:
+        raise ValueError(f'配置无效：{str(e)}')
+    return snapshot
+
+# 从数据库加载配置并替换快照
+def load_config():
+    global CONFIG
+    values = CONFIG_DEFAULTS._asdict()
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT key, value FROM bot_config')
+    for key, value in c.fetchall():
+        if key not in CONFIG_FIELDS:
+            continue
+        # 数据库中的无效值（旧版本写入）忽略，使用默认值，避免机器人无法启动
+        try:
+            values[key] = parse_config_value(key, value)
+        except ValueError as e:
+            print(f'⚠️ 忽略无效的配置项 {key}={value}：{str(e)}')
+    conn.close()
+    snapshot = ConfigSnapshot(**values)
+    try:
+        validate_config(snapshot)
+    except ValueError as e:
+        print(f'⚠️ {str(e)}，体验时长使用默认值')
+        snapshot = snapshot._replace(experience_duration_hours=CONFIG_DEFAULTS.experience_duration_hours)
+    CONFIG = snapshot
+    return CONFIG
+
+# 获取已写入数据库的配置项
+def get_stored_config_keys():
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT key FROM bot_config')
+    results = {row[0] for row in c.fetchall()}
+    conn.close()
+    return results
+
+# 保存配置项
+def save_config_value(key, value):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        INSERT OR REPLACE INTO bot_config (key, value, updated_at)
+        VALUES (?, ?, ?)
+    ''', (key, str(value), clock.now().isoformat()))
+    conn.commit()
+    conn.close()
+
+# 表中缺少字段时补上（兼容旧数据库）
+def _ensure_column(c, table, column, decl):
+    c.execute(f'PRAGMA table_info({table})')
+    if column not in {row[1] for row in c.fetchall()}:
+        c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
 
 # 数据库初始化
 def init_db():
-    conn = sqlite3.connect('vip_experience.db')
+    conn = get_db()
     c = conn.cursor()
     
+    # WAL 模式：读写互不阻塞，在线备份可以在持续写入的同时读取一致的快照
+    c.execute('PRAGMA journal_mode=WAL')
+    
     # 体验会员表（保留原有功能）
     c.execute('''
         CREATE TABLE IF NOT EXISTS user_experience (
@@ -52,13 +223,159 @@ def init_db():
             FOREIGN KEY (role_id) REFERENCES role_configs(role_id)
         )
     ''')
-    
+
+    # 成员名字缓存：列表中显示的名字，过期后重新从 Gateway 查询
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS member_names (
+            user_id INTEGER PRIMARY KEY,
+            display_name TEXT,
+            in_guild INTEGER NOT NULL,
+            resolved_at TEXT NOT NULL
+        )
+    ''')
+
+    # 体验等候队列（先进先出）
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS trial_waitlist (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL UNIQUE,
+            queued_at TEXT NOT NULL
+        )
+    ''')
+
+    # 身份组记录历史表：被续期合并、替换、撤销或删除的区间
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS user_roles_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            record_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            role_id INTEGER NOT NULL,
+            start_time TEXT,
+            end_time TEXT,
+            duration_days INTEGER,
+            reason TEXT NOT NULL,
+            archived_at TEXT NOT NULL
+        )
+    ''')
+
+    # 待撤销任务表（outbox）：到期的撤销先落库，再由 worker 执行
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS revocation_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            role_id INTEGER NOT NULL,
+            record_id INTEGER NOT NULL DEFAULT 0,
+            due_time TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            outcome TEXT,
+            last_error TEXT,
+            created_at TEXT,
+            updated_at TEXT,
+            UNIQUE (kind, user_id, role_id, record_id, due_time)
+        )
+    ''')
+
+    # 运行时配置表（覆盖环境变量中的默认值）
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS bot_config (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TEXT
+        )
+    ''')
+
+    # 运行状态表（扫描水位等）
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+    # 到期提醒记录表（也记录等候队列的开通通知）：同一个截止时间的同一档提醒只发送一次
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS expiry_notices (
+            kind TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            role_id INTEGER NOT NULL,
+            deadline TEXT NOT NULL,
+            threshold TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT,
+            PRIMARY KEY (kind, user_id, role_id, deadline, threshold)
+        )
+    ''')
+
+    # 每日汇总表（增量更新）
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,
+            trials_started INTEGER NOT NULL DEFAULT 0,
+            roles_granted INTEGER NOT NULL DEFAULT 0,
+            conversions INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    # 按体验开始日期分组的转化汇总表
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS trial_cohorts (
+            cohort_day TEXT PRIMARY KEY,
+            trials INTEGER NOT NULL DEFAULT 0,
+            converted INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    # 体验用户转化记录（每个用户只计一次）
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS trial_conversions (
+            user_id INTEGER PRIMARY KEY,
+            cohort_day TEXT NOT NULL,
+            role_id INTEGER,
+            converted_at TEXT
+        )
+    ''')
+
+    # 观察到的身份组赋予时间：对账据此识别到期后人工重新赋予的身份组（重启后仍然有效）
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS role_grants (
+            user_id INTEGER NOT NULL,
+            role_id INTEGER NOT NULL,
+            granted_at TEXT NOT NULL,
+            PRIMARY KEY (user_id, role_id)
+        )
+    ''')
+
+    # 旧版本的撤销任务表没有领取字段
+    _ensure_column(c, 'revocation_jobs', 'claimed_by', 'TEXT')
+
+    c.execute('CREATE INDEX IF NOT EXISTS idx_revocation_jobs_status ON revocation_jobs (status, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_user_experience_start ON user_experience (used, start_time)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_user_roles_end ON user_roles (end_time)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_user_roles_role_user ON user_roles (role_id, user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_user_roles_history_user ON user_roles_history (user_id, role_id)')
+    # 每个 (用户, 身份组) 只保留一条记录；旧数据库中的重复记录先合并
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_user_roles_user_role'")
+    if not c.fetchone():
+        merged = _merge_duplicate_user_roles(c)
+        if merged:
+            print(f'已合并 {merged} 条重复的身份组记录（原记录保存在 user_roles_history）')
+        c.execute('CREATE UNIQUE INDEX idx_user_roles_user_role ON user_roles (user_id, role_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_revocation_jobs_role_user ON revocation_jobs (role_id, user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_revocation_jobs_due ON revocation_jobs (due_time)')
+
     conn.commit()
     conn.close()
 
+    # 首次运行时根据现有记录回填汇总表
+    if not get_analytics_built():
+        rebuild_analytics()
+
 # 获取用户信息
 def get_user_info(user_id):
-    conn = sqlite3.connect('vip_experience.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT start_time, used FROM user_experience WHERE user_id = ?', (user_id,))
     result = c.fetchone()
@@ -67,7 +384,7 @@ def get_user_info(user_id):
 
 # 保存用户信息
 def save_user_info(user_id, start_time, used=0):
-    conn = sqlite3.connect('vip_experience.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('''
         INSERT OR REPLACE INTO user_experience (user_id, start_time, used)
@@ -78,7 +395,7 @@ def save_user_info(user_id, start_time, used=0):
 
 # 更新使用状态
 def mark_as_used(user_id):
-    conn = sqlite3.connect('vip_experience.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('UPDATE user_experience SET used = 1 WHERE user_id = ?', (user_id,))
     conn.commit()
@@ -86,7 +403,7 @@ def mark_as_used(user_id):
 
 # 删除用户记录
 def delete_user_info(user_id):
-    conn = sqlite3.connect('vip_experience.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('DELETE FROM user_experience WHERE user_id = ?', (user_id,))
     conn.commit()
@@ -96,18 +413,18 @@ def delete_user_info(user_id):
 
 # 添加身份组配置
 def add_role_config(role_id, role_name, duration_days):
-    conn = sqlite3.connect('vip_experience.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('''
         INSERT OR REPLACE INTO role_configs (role_id, role_name, duration_days, created_at)
         VALUES (?, ?, ?, ?)
-    ''', (role_id, role_name, duration_days, datetime.now().isoformat()))
+    ''', (role_id, role_name, duration_days, clock.now().isoformat()))
     conn.commit()
     conn.close()
 
 # 获取所有身份组配置
 def get_all_role_configs():
-    conn = sqlite3.connect('vip_experience.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT role_id, role_name, duration_days FROM role_configs')
     results = c.fetchall()
@@ -116,7 +433,7 @@ def get_all_role_configs():
 
 # 获取身份组配置
 def get_role_config(role_id):
-    conn = sqlite3.connect('vip_experience.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT role_id, role_name, duration_days FROM role_configs WHERE role_id = ?', (role_id,))
     result = c.fetchone()
@@ -125,7 +442,7 @@ def get_role_config(role_id):
 
 # 删除身份组配置
 def delete_role_config(role_id):
-    conn = sqlite3.connect('vip_experience.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('DELETE FROM role_configs WHERE role_id = ?', (role_id,))
     conn.commit()
@@ -133,23 +450,71 @@ def delete_role_config(role_id):
 
 # ========== 用户身份组记录相关函数 ==========
 
-# 添加用户身份组记录
+# 在同一个连接上把身份组记录的当前区间写入历史表
+def _archive_user_role(c, record_id, reason):
+    c.execute('''
+        INSERT INTO user_roles_history
+            (record_id, user_id, role_id, start_time, end_time, duration_days, reason, archived_at)
+        SELECT id, user_id, role_id, start_time, end_time, duration_days, ?, ?
+        FROM user_roles WHERE id = ?
+    ''', (reason, clock.now().isoformat(), record_id))
+    return c.rowcount
+
+# 合并同一用户同一身份组的重复记录：保留到期时间最晚的一条，其余写入历史表后删除
+def _merge_duplicate_user_roles(c):
+    c.execute('SELECT user_id, role_id FROM user_roles GROUP BY user_id, role_id HAVING COUNT(*) > 1')
+    merged = 0
+    for user_id, role_id in c.fetchall():
+        c.execute('''
+            SELECT id FROM user_roles WHERE user_id = ? AND role_id = ?
+            ORDER BY end_time DESC, id DESC
+        ''', (user_id, role_id))
+        for (record_id,) in c.fetchall()[1:]:
+            _archive_user_role(c, record_id, 'merged')
+            c.execute('DELETE FROM user_roles WHERE id = ?', (record_id,))
+            merged += 1
+    return merged
+
+# 添加用户身份组记录：每个 (用户, 身份组) 只有一条记录
+# 仍在有效期内则合并区间（保留开始时间，到期时间取较晚者），已到期则替换为新区间；旧区间写入历史表
+# 返回合并后的 (开始时间, 到期时间)
 def add_user_role(user_id, role_id, duration_days):
-    start_time = datetime.now()
-    end_time = start_time + timedelta(days=duration_days)
-    conn = sqlite3.connect('vip_experience.db')
+    now = clock.now()
+    now_str = now.isoformat()
+    end_str = (now + timedelta(days=duration_days)).isoformat()
+    conn = get_db()
     c = conn.cursor()
-    c.execute('''
-        INSERT INTO user_roles (user_id, role_id, start_time, end_time, duration_days)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, role_id, start_time.isoformat(), end_time.isoformat(), duration_days))
-    conn.commit()
-    conn.close()
-    return end_time
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        c.execute('SELECT id, end_time FROM user_roles WHERE user_id = ? AND role_id = ?', (user_id, role_id))
+        row = c.fetchone()
+        if row and row[1] <= now_str:
+            _archive_user_role(c, row[0], 'replaced')
+        elif row and row[1] < end_str:
+            _archive_user_role(c, row[0], 'extended')
+        c.execute('''
+            INSERT INTO user_roles (user_id, role_id, start_time, end_time, duration_days)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, role_id) DO UPDATE SET
+                start_time = CASE WHEN user_roles.end_time > excluded.start_time
+                                  THEN user_roles.start_time ELSE excluded.start_time END,
+                duration_days = CASE WHEN excluded.end_time > user_roles.end_time
+                                     THEN excluded.duration_days ELSE user_roles.duration_days END,
+                end_time = MAX(user_roles.end_time, excluded.end_time)
+            RETURNING start_time, end_time
+        ''', (user_id, role_id, now_str, end_str, duration_days))
+        start_str, end_str = c.fetchone()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return datetime.fromisoformat(start_str), datetime.fromisoformat(end_str)
 
 # 获取用户的所有身份组记录
 def get_user_roles(user_id):
-    conn = sqlite3.connect('vip_experience.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('''
         SELECT ur.id, ur.role_id, ur.start_time, ur.end_time, ur.duration_days, rc.role_name
@@ -164,9 +529,9 @@ def get_user_roles(user_id):
 
 # 获取所有未过期的用户身份组记录
 def get_all_active_user_roles():
-    conn = sqlite3.connect('vip_experience.db')
+    conn = get_db()
     c = conn.cursor()
-    now = datetime.now().isoformat()
+    now = clock.now().isoformat()
     c.execute('''
         SELECT ur.id, ur.user_id, ur.role_id, ur.start_time, ur.end_time, ur.duration_days, rc.role_name
         FROM user_roles ur
@@ -178,258 +543,1465 @@ def get_all_active_user_roles():
     conn.close()
     return results
 
-# 删除用户身份组记录
+# 删除用户身份组记录（原记录写入历史表）
 def delete_user_role(record_id):
-    conn = sqlite3.connect('vip_experience.db')
+    conn = get_db()
     c = conn.cursor()
+    _archive_user_role(c, record_id, 'deleted')
     c.execute('DELETE FROM user_roles WHERE id = ?', (record_id,))
     conn.commit()
     conn.close()
 
-# 计算剩余时间
-def get_remaining_time(start_time_str):
-    if not start_time_str:
-        return None
-    start_time = datetime.fromisoformat(start_time_str)
-    end_time = start_time + timedelta(hours=EXPERIENCE_DURATION_HOURS)
-    now = datetime.now()
-    if now >= end_time:
-        return None  # 已过期
-    remaining = end_time - now
-    return remaining
+# ========== 撤销任务（outbox）相关函数 ==========
 
-# 创建机器人
-intents = discord.Intents.default()
-intents.message_content = True
-intents.members = True  # 必须开启，机器人才能在后台看到所有成员
-bot = commands.Bot(command_prefix='!', intents=intents)
+REVOCATION_MAX_ATTEMPTS = 5
+REVOCATION_LEASE_SECONDS = 120  # 领取后超过该时间未完成的任务视为执行者已崩溃，重新放回队列
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
 
-# 错误处理：权限不足
-@bot.tree.error
-async def on_app_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+# 读取运行状态
+def get_state(c, key, default=None):
+    c.execute('SELECT value FROM bot_state WHERE key = ?', (key,))
+    row = c.fetchone()
+    return row[0] if row else default
+
+# 写入运行状态
+def set_state(c, key, value):
+    c.execute('INSERT OR REPLACE INTO bot_state (key, value) VALUES (?, ?)', (key, value))
+
+# 把所有到期的撤销写成待执行任务（单个事务）
+def enqueue_due_revocations(vip_role_id):
+    now = clock.now()
+    now_str = now.isoformat()
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
     try:
-        if isinstance(error, app_commands.MissingPermissions):
-            if not interaction.response.is_done():
-                await interaction.response.send_message('❌ 您没有权限使用此命令！', ephemeral=True)
-            else:
-                await interaction.followup.send('❌ 您没有权限使用此命令！', ephemeral=True)
-        else:
-            # 检查交互是否已经响应
-            if not interaction.response.is_done():
-                await interaction.response.send_message(f'❌ 发生错误：{str(error)}', ephemeral=True)
-            else:
-                # 如果已经响应过，使用 followup
-                await interaction.followup.send(f'❌ 发生错误：{str(error)}', ephemeral=True)
-    except discord.errors.NotFound:
-        # 交互已过期，无法响应
-        print(f'⚠️ 交互已过期，无法发送错误消息：{str(error)}')
-    except Exception as e:
-        print(f'❌ 错误处理时发生异常：{str(e)}')
-        import traceback
-        traceback.print_exc()
+        jobs = []
 
-# 翻页视图
-class PaginatedView(discord.ui.View):
-    def __init__(self, pages, initial_page=0):
-        super().__init__(timeout=300)  # 5分钟超时
-        self.pages = pages
-        self.current_page = initial_page
-        self.max_page = len(pages) - 1
-        self.update_buttons()
-    
-    def update_buttons(self):
-        # 清除所有按钮
-        self.clear_items()
-        
-        # 上一页按钮
-        prev_button = discord.ui.Button(
-            label='上一页',
-            style=discord.ButtonStyle.primary,
-            emoji='◀️',
-            disabled=self.current_page == 0
-        )
-        prev_button.callback = self.previous_page
-        self.add_item(prev_button)
-        
-        # 页码显示
-        page_button = discord.ui.Button(
-            label=f'{self.current_page + 1}/{self.max_page + 1}',
-            style=discord.ButtonStyle.secondary,
-            disabled=True
-        )
-        self.add_item(page_button)
-        
-        # 下一页按钮
-        next_button = discord.ui.Button(
-            label='下一页',
-            style=discord.ButtonStyle.primary,
-            emoji='▶️',
-            disabled=self.current_page >= self.max_page
-        )
-        next_button.callback = self.next_page
-        self.add_item(next_button)
-    
-    async def previous_page(self, interaction: discord.Interaction):
-        if self.current_page > 0:
-            self.current_page -= 1
-            self.update_buttons()
-            await interaction.response.edit_message(embed=self.pages[self.current_page], view=self)
-    
-    async def next_page(self, interaction: discord.Interaction):
-        if self.current_page < self.max_page:
-            self.current_page += 1
-            self.update_buttons()
-            await interaction.response.edit_message(embed=self.pages[self.current_page], view=self)
+        # 体验会员：只扫描上次水位之后到期的记录
+        if vip_role_id:
+            cutoff = (now - timedelta(hours=CONFIG.experience_duration_hours)).isoformat()
+            watermark = get_state(c, 'experience_watermark', '')
+            c.execute('''
+                SELECT user_id, start_time FROM user_experience
+                WHERE used = 1 AND start_time > ? AND start_time <= ?
+                ORDER BY start_time
+            ''', (watermark, cutoff))
+            rows = c.fetchall()
+            for user_id, start_time_str in rows:
+                due = datetime.fromisoformat(start_time_str) + timedelta(hours=CONFIG.experience_duration_hours)
+                jobs.append(('experience', user_id, vip_role_id, 0, due.isoformat(), now_str, now_str))
+            if rows:
+                set_state(c, 'experience_watermark', rows[-1][1])
 
-# 按钮视图
-class ExperienceView(discord.ui.View):
-    def __init__(self):
-        super().__init__(timeout=None)
-    
-    @discord.ui.button(label='申请体验', style=discord.ButtonStyle.primary, emoji='✨')
-    async def apply_experience(self, interaction: discord.Interaction, button: discord.ui.Button):
-        user_id = interaction.user.id
-        user_info = get_user_info(user_id)
-        
-        # 检查是否已经使用过
-        if user_info and user_info[1] == 1:
-            await interaction.response.send_message(
-                '❌ 您已经使用过体验机会了，每个会员只能获得一次体验机会！',
-                ephemeral=True
-            )
-            return
-        
-        # 检查是否正在体验中
-        if user_info and user_info[0]:
-            remaining = get_remaining_time(user_info[0])
-            if remaining:
-                total_seconds = int(remaining.total_seconds())
-                hours = total_seconds // 3600
-                minutes = (total_seconds % 3600) // 60
-                await interaction.response.send_message(
-                    f'⚠️ 您正在体验中，剩余时间：{hours}小时{minutes}分钟',
-                    ephemeral=True
-                )
-                return
-        
-        # 赋予身份组
-        guild = interaction.guild
-        role = guild.get_role(VIP_ROLE_ID)
-        if not role:
-            await interaction.response.send_message(
-                '❌ 错误：找不到会员身份组，请检查配置！',
-                ephemeral=True
-            )
-            return
-        
-        try:
-            await interaction.user.add_roles(role)
-            start_time = datetime.now().isoformat()
-            save_user_info(user_id, start_time, used=1)
-            
-            await interaction.response.send_message(
-                f'✅ 体验权限已激活！\n'
-                f'⏰ 体验时长：{EXPERIENCE_DURATION_HOURS}小时\n'
-                f'📅 到期时间：{(datetime.now() + timedelta(hours=EXPERIENCE_DURATION_HOURS)).strftime("%Y-%m-%d %H:%M:%S")}\n'
-                f'⚠️ 时间结束后，权限将自动移除',
-                ephemeral=True
-            )
-        except discord.Forbidden:
-            await interaction.response.send_message(
-                '❌ 错误：机器人没有权限赋予身份组！',
-                ephemeral=True
-            )
-        except Exception as e:
-            await interaction.response.send_message(
-                f'❌ 发生错误：{str(e)}',
-                ephemeral=True
-            )
-    
-    @discord.ui.button(label='查询时长', style=discord.ButtonStyle.secondary, emoji='⏰')
-    async def check_time(self, interaction: discord.Interaction, button: discord.ui.Button):
-        user_id = interaction.user.id
-        user_info = get_user_info(user_id)
-        
-        if not user_info or not user_info[0]:
-            await interaction.response.send_message(
-                '❌ 您还没有申请体验权限！',
-                ephemeral=True
+        # 手动赋予的身份组：已到期且还没有对应任务的记录
+        c.execute('''
+            SELECT ur.id, ur.user_id, ur.role_id, ur.end_time FROM user_roles ur
+            WHERE ur.end_time <= ? AND NOT EXISTS (
+                SELECT 1 FROM revocation_jobs j
+                WHERE j.kind = 'user_role' AND j.record_id = ur.id AND j.due_time = ur.end_time
             )
-            return
-        
-        remaining = get_remaining_time(user_info[0])
-        if not remaining:
-            # 如果已过期，立即移除身份组
-            guild = interaction.guild
-            role = guild.get_role(VIP_ROLE_ID)
-            if not role:
-                await interaction.response.send_message(
-                    '⏰ 您的体验时间已结束！但找不到会员身份组，请通知管理员。',
-                    ephemeral=True
-                )
-                return
-            
-            member = guild.get_member(user_id)
-            if not member:
-                await interaction.response.send_message(
-                    '⏰ 您的体验时间已结束！',
-                    ephemeral=True
-                )
-                return
-            
-            if role not in member.roles:
-                # 用户已经没有身份组了
-                await interaction.response.send_message(
-                    '⏰ 您的体验时间已结束！身份组已被移除。',
-                    ephemeral=True
-                )
-                return
-            
-            # 用户还有身份组，需要移除
-            try:
-                await member.remove_roles(role)
-                print(f'✅ [查询时长] 已移除用户 {member.name} ({user_id}) 的体验权限')
-                await interaction.response.send_message(
-                    '⏰ 您的体验时间已结束！身份组已自动移除。',
-                    ephemeral=True
-                )
-            except discord.Forbidden:
-                print(f'❌ [查询时长] 权限不足：无法移除用户 {member.name} ({user_id}) 的身份组')
-                print(f'   提示：确保机器人的身份组在服务器身份组列表中位于会员身份组之上')
-                await interaction.response.send_message(
-                    '⏰ 您的体验时间已结束！\n'
-                    '❌ 但移除身份组时权限不足，请通知管理员检查机器人权限。',
-                    ephemeral=True
-                )
-            except Exception as e:
-                print(f'❌ [查询时长] 移除用户 {member.name} ({user_id}) 权限时出错：{str(e)}')
-                import traceback
-                traceback.print_exc()
-                await interaction.response.send_message(
-                    f'⏰ 您的体验时间已结束！\n'
-                    f'❌ 但移除身份组时出错：{str(e)}\n'
-                    f'请通知管理员。',
-                    ephemeral=True
-                )
+        ''', (now_str,))
+        for record_id, user_id, role_id, end_time_str in c.fetchall():
+            jobs.append(('user_role', user_id, role_id, record_id, end_time_str, now_str, now_str))
+
+        # 回收崩溃的执行者领取后未完成的任务
+        lease_cutoff = (now - timedelta(seconds=REVOCATION_LEASE_SECONDS)).isoformat()
+        c.execute('''
+            UPDATE revocation_jobs SET status = 'pending', claimed_by = NULL
+            WHERE status = 'running' AND updated_at < ?
+        ''', (lease_cutoff,))
+
+        c.executemany('''
+            INSERT OR IGNORE INTO revocation_jobs
+                (kind, user_id, role_id, record_id, due_time, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', jobs)
+        enqueued = c.rowcount if jobs else 0
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return enqueued
+
+# 体验时长变长后回退扫描水位，让尚未到期的体验在新的到期时间重新入队
+def rewind_experience_watermark(duration_hours):
+    cutoff = (clock.now() - timedelta(hours=duration_hours)).isoformat()
+    conn = get_db()
+    c = conn.cursor()
+    if get_state(c, 'experience_watermark', '') > cutoff:
+        set_state(c, 'experience_watermark', cutoff)
+    conn.commit()
+    conn.close()
+
+# 领取一批待执行的撤销任务；多个进程同时执行时每个任务只会被一个进程领取
+def claim_revocations(after_id=0, limit=500):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    c.execute('''
+        UPDATE revocation_jobs SET status = 'running', claimed_by = ?, updated_at = ?
+        WHERE id IN (
+            SELECT id FROM revocation_jobs
+            WHERE status = 'pending' AND id > ?
+            ORDER BY id
+            LIMIT ?
+        )
+        RETURNING id, kind, user_id, role_id, record_id, due_time, attempts
+    ''', (WORKER_ID, clock.now().isoformat(), after_id, limit))
+    results = sorted(c.fetchall())
+    conn.commit()
+    conn.close()
+    return results
+
+# 执行前再次确认任务仍然有效（记录可能已被续期或重新申请）
+def is_revocation_still_due(kind, user_id, role_id, record_id, due_time):
+    if kind == 'user_role':
+        conn = get_db()
+        c = conn.cursor()
+        c.execute('SELECT end_time FROM user_roles WHERE id = ?', (record_id,))
+        row = c.fetchone()
+        conn.close()
+        return row is not None and row[0] == due_time
+
+    # 体验/对账任务：用户对该身份组已没有任何有效记录才撤销
+    entitled, _ = load_role_entitlements(role_id, [user_id])
+    return user_id not in entitled
+
+# 标记任务完成，并在同一事务中把对应的身份组记录移入历史表，返回最终结果
+# 撤销期间记录被续期（到期时间已不是任务的 due_time）时不删除新的记录，结果记为 superseded
+# 租约已过期并被其他进程重新领取时（claimed_by 不再是本进程）不做任何修改，结果记为 lease_lost
+def complete_revocation(job_id, kind, record_id, outcome, status='done', due_time=None):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    archive = False
+    if kind == 'user_role' and status == 'done':
+        c.execute('SELECT 1 FROM user_roles WHERE id = ? AND end_time = ?', (record_id, due_time))
+        if c.fetchone():
+            archive = True
         else:
-            total_seconds = int(remaining.total_seconds())
-            hours = total_seconds // 3600
-            minutes = (total_seconds % 3600) // 60
-            seconds = total_seconds % 60
-            start_time = datetime.fromisoformat(user_info[0])
-            end_time = start_time + timedelta(hours=EXPERIENCE_DURATION_HOURS)
-            
-            await interaction.response.send_message(
-                f'⏰ **剩余体验时间**\n'
-                f'📅 开始时间：{start_time.strftime("%Y-%m-%d %H:%M:%S")}\n'
-                f'📅 到期时间：{end_time.strftime("%Y-%m-%d %H:%M:%S")}\n'
-                f'⏳ 剩余时长：{hours}小时{minutes}分钟{seconds}秒',
-                ephemeral=True
-            )
+            outcome, status = 'superseded', 'cancelled'
+    c.execute('''
+        UPDATE revocation_jobs SET status = ?, outcome = ?, updated_at = ?
+        WHERE id = ? AND status = 'running' AND claimed_by = ?
+    ''', (status, outcome, clock.now().isoformat(), job_id, WORKER_ID))
+    if not c.rowcount:
+        conn.rollback()
+        conn.close()
+        return 'lease_lost'
+    if archive:
+        _archive_user_role(c, record_id, 'expired')
+        c.execute('DELETE FROM user_roles WHERE id = ? AND end_time = ?', (record_id, due_time))
+    conn.commit()
+    conn.close()
+    return outcome
 
-# 移除单个用户的过期权限
-async def remove_expired_role(user_id, guild, role):
-    """移除单个用户的过期权限"""
+# 记录任务失败；超过最大重试次数后不再执行
+def fail_revocation(job_id, error):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        UPDATE revocation_jobs
+        SET attempts = attempts + 1,
+            last_error = ?,
+            status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END,
+            claimed_by = NULL,
+            updated_at = ?
+        WHERE id = ? AND status = 'running' AND claimed_by = ?
+    ''', (error, REVOCATION_MAX_ATTEMPTS, clock.now().isoformat(), job_id, WORKER_ID))
+    conn.commit()
+    conn.close()
+
+# ========== 对账（数据库记录 vs 实际身份组）相关函数 ==========
+
+# 获取需要对账的身份组ID（会员身份组 + 已配置的身份组）
+def get_tracked_role_ids():
+    role_ids = {role_id for role_id, _, _ in get_all_role_configs()}
+    if CONFIG.vip_role_id:
+        role_ids.add(CONFIG.vip_role_id)
+    return role_ids
+
+# 生成 "AND user_id IN (...)" 过滤条件
+def _user_filter(user_ids, column='user_id'):
+    if user_ids is None:
+        return '', ()
+    return f' AND {column} IN ({",".join("?" * len(user_ids))})', tuple(user_ids)
+
+# 只有最近到期的用户才会被当作漂移自动撤销；更早到期的持有者多半是管理员人工重新赋予的
+RECONCILE_DRIFT_WINDOW = timedelta(hours=24)
+
+# 记录成员被赋予身份组的时间（到期之后才赋予的视为人工重新赋予，不自动撤销）
+def note_role_granted(user_id, role_ids):
+    if not role_ids:
+        return
+    now_str = clock.now().isoformat()
+    conn = get_db()
+    c = conn.cursor()
+    c.executemany('''
+        INSERT INTO role_grants (user_id, role_id, granted_at) VALUES (?, ?, ?)
+        ON CONFLICT (user_id, role_id) DO UPDATE SET granted_at = excluded.granted_at
+    ''', [(user_id, role_id, now_str) for role_id in role_ids])
+    conn.commit()
+    conn.close()
+
+# 清理超出对账窗口的赋予记录（早于窗口的赋予不可能晚于窗口内的到期时间）
+def prune_role_grants():
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('DELETE FROM role_grants WHERE granted_at < ?', ((clock.now() - RECONCILE_DRIFT_WINDOW).isoformat(),))
+    conn.commit()
+    conn.close()
+
+# 读取某个身份组最近一次观察到的赋予时间：{用户ID: datetime}
+def load_role_grants(role_id, user_ids=None):
+    grants = {}
+    conn = get_db()
+    c = conn.cursor()
+    user_ids = list(user_ids) if user_ids is not None else None
+    batches = [user_ids[i:i + 500] for i in range(0, len(user_ids), 500)] if user_ids is not None else [None]
+    for batch in batches:
+        where, params = _user_filter(batch)
+        c.execute('SELECT user_id, granted_at FROM role_grants WHERE role_id = ?' + where, (role_id,) + params)
+        for user_id, granted_at in c.fetchall():
+            grants[user_id] = datetime.fromisoformat(granted_at)
+    conn.close()
+    return grants
+
+# 读取某个身份组的有效用户集合和最近到期的用户
+# entitled：当前仍在有效期内；expired：到期时间在 RECONCILE_DRIFT_WINDOW 内的用户 -> 最晚到期时间
+def load_role_entitlements(role_id, user_ids=None):
+    entitled = set()
+    expired = {}
+    now = clock.now()
+    now_str = now.isoformat()
+    window_start = now - RECONCILE_DRIFT_WINDOW
+    conn = get_db()
+    c = conn.cursor()
+
+    def note_expired(user_id, expiry):
+        if user_id not in expired or expiry > expired[user_id]:
+            expired[user_id] = expiry
+
+    # SQLite 参数个数有限，按批查询
+    user_ids = list(user_ids) if user_ids is not None else None
+    batches = [user_ids[i:i + 500] for i in range(0, len(user_ids), 500)] if user_ids is not None else [None]
+    for batch in batches:
+        where, params = _user_filter(batch)
+
+        if role_id == CONFIG.vip_role_id:
+            duration = timedelta(hours=CONFIG.experience_duration_hours)
+            c.execute('SELECT user_id, start_time FROM user_experience WHERE used = 1 AND start_time > ?' + where,
+                      ((window_start - duration).isoformat(),) + params)
+            for user_id, start_time in c.fetchall():
+                end_time = datetime.fromisoformat(start_time) + duration
+                if end_time > now:
+                    entitled.add(user_id)
+                else:
+                    note_expired(user_id, end_time)
+
+        c.execute('SELECT user_id, end_time FROM user_roles WHERE role_id = ? AND end_time > ?' + where,
+                  (role_id, window_start.isoformat()) + params)
+        for user_id, end_time in c.fetchall():
+            if end_time > now_str:
+                entitled.add(user_id)
+            else:
+                note_expired(user_id, datetime.fromisoformat(end_time))
+
+        # 记录撤销后已移入历史表，最近的撤销任务同样表示最近到期
+        c.execute('SELECT user_id, due_time FROM revocation_jobs WHERE role_id = ? AND due_time > ?' + where,
+                  (role_id, window_start.isoformat()) + params)
+        for user_id, due_time in c.fetchall():
+            note_expired(user_id, datetime.fromisoformat(due_time))
+
+    conn.close()
+    return entitled, expired
+
+# 对比实际持有者与数据库记录
+# drift：最近到期、到期后没有再被赋予，却仍持有身份组（需要撤销）
+# missing：仍在有效期内，却没有身份组（只报告，不自动补发）
+# untracked：没有有效记录的其他持有者（没有记录、很早以前到期或到期后被人工重新赋予，不处理）
+def diff_role_membership(holders, entitled, expired, grants):
+    drift = set()
+    for user_id in holders - entitled:
+        granted_at = grants.get(user_id)
+        if user_id in expired and (granted_at is None or granted_at <= expired[user_id]):
+            drift.add(user_id)
+    missing = entitled - holders
+    untracked = holders - entitled - drift
+    return drift, missing, untracked
+
+# 把对账发现的漂移写成待撤销任务（单个事务，已有待执行任务的跳过）
+def enqueue_reconcile_revocations(pairs):
+    if not pairs:
+        return 0
+    now_str = clock.now().isoformat()
+    conn = get_db()
+    c = conn.cursor()
+    c.executemany('''
+        INSERT OR IGNORE INTO revocation_jobs
+            (kind, user_id, role_id, record_id, due_time, created_at, updated_at)
+        SELECT 'reconcile', ?, ?, 0, ?, ?, ?
+        WHERE NOT EXISTS (
+            SELECT 1 FROM revocation_jobs
+            WHERE user_id = ? AND role_id = ? AND status IN ('pending', 'running')
+        )
+    ''', [(user_id, role_id, now_str, now_str, now_str, user_id, role_id) for user_id, role_id in pairs])
+    enqueued = c.rowcount
+    conn.commit()
+    conn.close()
+    return enqueued
+
+# ========== 到期提醒相关函数 ==========
+
+# 获取所有仍在有效期内的截止时间：(kind, user_id, role_id, start_time, deadline)
+def get_active_deadlines():
+    now = clock.now()
+    deadlines = []
+    conn = get_db()
+    c = conn.cursor()
+    if CONFIG.vip_role_id:
+        cutoff = (now - timedelta(hours=CONFIG.experience_duration_hours)).isoformat()
+        c.execute('SELECT user_id, start_time FROM user_experience WHERE used = 1 AND start_time > ?', (cutoff,))
+        for user_id, start_time_str in c.fetchall():
+            start_time = datetime.fromisoformat(start_time_str)
+            deadlines.append(('experience', user_id, CONFIG.vip_role_id, start_time, start_time + timedelta(hours=CONFIG.experience_duration_hours)))
+    c.execute('SELECT user_id, role_id, start_time, end_time FROM user_roles WHERE end_time > ? ORDER BY end_time', (now.isoformat(),))
+    for user_id, role_id, start_time_str, end_time_str in c.fetchall():
+        deadlines.append(('user_role', user_id, role_id, datetime.fromisoformat(start_time_str), datetime.fromisoformat(end_time_str)))
+    conn.close()
+    return deadlines
+
+# 获取当前生效的截止时间（记录被删除或续期后提醒作废）
+def get_current_deadline(kind, user_id, role_id):
+    conn = get_db()
+    c = conn.cursor()
+    if kind == 'experience':
+        c.execute('SELECT start_time FROM user_experience WHERE user_id = ? AND used = 1', (user_id,))
+        row = c.fetchone()
+        deadline = datetime.fromisoformat(row[0]) + timedelta(hours=CONFIG.experience_duration_hours) if row and row[0] else None
+    else:
+        c.execute('SELECT MAX(end_time) FROM user_roles WHERE user_id = ? AND role_id = ?', (user_id, role_id))
+        row = c.fetchone()
+        deadline = datetime.fromisoformat(row[0]) if row and row[0] else None
+    conn.close()
+    return deadline
+
+# 登记一条待发送的提醒；已发送或已放弃的提醒返回 False
+def claim_expiry_notice(kind, user_id, role_id, deadline, threshold):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        INSERT OR IGNORE INTO expiry_notices (kind, user_id, role_id, deadline, threshold, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (kind, user_id, role_id, deadline, threshold, clock.now().isoformat()))
+    c.execute('''
+        SELECT status FROM expiry_notices
+        WHERE kind = ? AND user_id = ? AND role_id = ? AND deadline = ? AND threshold = ?
+    ''', (kind, user_id, role_id, deadline, threshold))
+    status = c.fetchone()[0]
+    conn.commit()
+    conn.close()
+    return status == 'queued'
+
+# 更新提醒发送状态
+def set_expiry_notice_status(notice_key, status):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        UPDATE expiry_notices SET status = ?, attempts = attempts + 1, updated_at = ?
+        WHERE kind = ? AND user_id = ? AND role_id = ? AND deadline = ? AND threshold = ?
+    ''', (status, clock.now().isoformat()) + tuple(notice_key))
+    conn.commit()
+    conn.close()
+
+# 读取已登记但尚未发送的某类通知：[(用户ID, 身份组ID, 截止时间, 档位)]
+def get_queued_notices(kind):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        SELECT user_id, role_id, deadline, threshold FROM expiry_notices
+        WHERE kind = ? AND status = 'queued' AND deadline > ?
+    ''', (kind, clock.now().isoformat()))
+    results = c.fetchall()
+    conn.close()
+    return results
+
+# 清理已经过期很久的提醒记录
+def prune_expiry_notices(days=7):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('DELETE FROM expiry_notices WHERE deadline < ?', ((clock.now() - timedelta(days=days)).isoformat(),))
+    conn.commit()
+    conn.close()
+
+# 获取所有有记录的用户ID（体验记录 + 身份组记录 + 对账窗口内刚到期的用户）
+# 未缓存的成员身份组变化时 discord.py 不会触发 on_member_update，刚到期的用户需要继续缓存，
+# 对账窗口内人工重新赋予身份组才能被记录下来
+def get_tracked_user_ids():
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        SELECT user_id FROM user_experience
+        UNION SELECT user_id FROM user_roles
+        UNION SELECT user_id FROM revocation_jobs WHERE due_time > ?
+    ''', ((clock.now() - RECONCILE_DRIFT_WINDOW).isoformat(),))
+    results = {row[0] for row in c.fetchall()}
+    conn.close()
+    return results
+
+# 读取缓存的成员名字：{用户ID: (显示名字, 是否在服务器中, 解析时间)}
+def load_member_names(user_ids):
+    results = {}
+    conn = get_db()
+    c = conn.cursor()
+    user_ids = list(user_ids)
+    for i in range(0, len(user_ids), 500):
+        where, params = _user_filter(user_ids[i:i + 500])
+        c.execute('SELECT user_id, display_name, in_guild, resolved_at FROM member_names WHERE 1 = 1' + where, params)
+        for user_id, display_name, in_guild, resolved_at in c.fetchall():
+            results[user_id] = (display_name, bool(in_guild), datetime.fromisoformat(resolved_at))
+    conn.close()
+    return results
+
+# 保存成员名字：rows 为 (用户ID, 显示名字, 是否在服务器中, 解析时间)
+def save_member_names(rows):
+    conn = get_db()
+    c = conn.cursor()
+    c.executemany('''
+        INSERT INTO member_names (user_id, display_name, in_guild, resolved_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            display_name = COALESCE(excluded.display_name, member_names.display_name),
+            in_guild = excluded.in_guild,
+            resolved_at = excluded.resolved_at
+    ''', [(user_id, name, int(in_guild), resolved_at.isoformat()) for user_id, name, in_guild, resolved_at in rows])
+    conn.commit()
+    conn.close()
+
+# 用户是否还有任何记录
+def has_user_records(user_id):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        SELECT EXISTS (SELECT 1 FROM user_experience WHERE user_id = ?)
+            OR EXISTS (SELECT 1 FROM user_roles WHERE user_id = ?)
+    ''', (user_id, user_id))
+    result = bool(c.fetchone()[0])
+    conn.close()
+    return result
+
+# ========== 体验名额相关函数 ==========
+
+# 获取进行中的体验：[(用户ID, 到期时间)]
+def get_active_trials():
+    cutoff = (clock.now() - timedelta(hours=CONFIG.experience_duration_hours)).isoformat()
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT user_id, start_time FROM user_experience WHERE used = 1 AND start_time > ?', (cutoff,))
+    results = [
+        (user_id, datetime.fromisoformat(start_time_str) + timedelta(hours=CONFIG.experience_duration_hours))
+        for user_id, start_time_str in c.fetchall()
+    ]
+    conn.close()
+    return results
+
+# 获取等候队列（按加入顺序）
+def get_waitlist():
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT user_id FROM trial_waitlist ORDER BY id')
+    results = [row[0] for row in c.fetchall()]
+    conn.close()
+    return results
+
+# 加入等候队列
+def add_to_waitlist(user_id):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('INSERT OR IGNORE INTO trial_waitlist (user_id, queued_at) VALUES (?, ?)', (user_id, clock.now().isoformat()))
+    conn.commit()
+    conn.close()
+
+# 移出等候队列
+def remove_from_waitlist(user_id):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('DELETE FROM trial_waitlist WHERE user_id = ?', (user_id,))
+    conn.commit()
+    conn.close()
+
+# ========== 统计与导出相关函数 ==========
+
+EXPORT_TABLES = ['user_experience', 'user_roles', 'user_roles_history', 'daily_stats', 'trial_cohorts', 'trial_conversions']
+EXPORT_FORMATS = ['csv', 'parquet']
+EXPORT_BATCH_SIZE = 5000
+EXPORT_DIR = 'exports'
+
+# 汇总表是否已回填
+def get_analytics_built():
+    conn = get_db()
+    c = conn.cursor()
+    built = get_state(c, 'analytics_built')
+    conn.close()
+    return built is not None
+
+# 在同一个连接上累加每日汇总
+def _bump_daily_stats(c, day, trials_started=0, roles_granted=0, conversions=0):
+    c.execute('''
+        INSERT INTO daily_stats (day, trials_started, roles_granted, conversions)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(day) DO UPDATE SET
+            trials_started = trials_started + excluded.trials_started,
+            roles_granted = roles_granted + excluded.roles_granted,
+            conversions = conversions + excluded.conversions
+    ''', (day, trials_started, roles_granted, conversions))
+
+# 在同一个连接上累加体验分组汇总
+def _bump_trial_cohort(c, cohort_day, trials=0, converted=0):
+    c.execute('''
+        INSERT INTO trial_cohorts (cohort_day, trials, converted)
+        VALUES (?, ?, ?)
+        ON CONFLICT(cohort_day) DO UPDATE SET
+            trials = trials + excluded.trials,
+            converted = converted + excluded.converted
+    ''', (cohort_day, trials, converted))
+
+# 在同一个连接上记录转化：体验过的用户之后第一次获得身份组
+def _record_conversion(c, user_id, role_id, granted_at):
+    c.execute('SELECT start_time FROM user_experience WHERE user_id = ? AND used = 1', (user_id,))
+    row = c.fetchone()
+    if not row or not row[0] or row[0] > granted_at:
+        return
+    cohort_day = row[0][:10]
+    c.execute('''
+        INSERT OR IGNORE INTO trial_conversions (user_id, cohort_day, role_id, converted_at)
+        VALUES (?, ?, ?, ?)
+    ''', (user_id, cohort_day, role_id, granted_at))
+    if c.rowcount:
+        _bump_trial_cohort(c, cohort_day, converted=1)
+        _bump_daily_stats(c, granted_at[:10], conversions=1)
+
+# 统计：新增体验用户
+def record_trial_started(user_id, start_time):
+    conn = get_db()
+    c = conn.cursor()
+    _bump_daily_stats(c, start_time[:10], trials_started=1)
+    _bump_trial_cohort(c, start_time[:10], trials=1)
+    conn.commit()
+    conn.close()
+
+# 统计：赋予身份组（并判断是否为体验转化）
+def record_role_granted(user_id, role_id, granted_at):
+    conn = get_db()
+    c = conn.cursor()
+    _bump_daily_stats(c, granted_at[:10], roles_granted=1)
+    _record_conversion(c, user_id, role_id, granted_at)
+    conn.commit()
+    conn.close()
+
+# 根据现有记录重建汇总表
+def rebuild_analytics():
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        c.execute('DELETE FROM daily_stats')
+        c.execute('DELETE FROM trial_cohorts')
+        c.execute('DELETE FROM trial_conversions')
+        c.execute('''
+            INSERT INTO trial_cohorts (cohort_day, trials)
+            SELECT substr(start_time, 1, 10), COUNT(*) FROM user_experience
+            WHERE used = 1 AND start_time IS NOT NULL
+            GROUP BY 1
+        ''')
+        c.execute('''
+            INSERT INTO daily_stats (day, trials_started)
+            SELECT cohort_day, trials FROM trial_cohorts
+        ''')
+        c.execute('SELECT user_id, role_id, start_time FROM user_roles ORDER BY start_time')
+        for user_id, role_id, start_time_str in c.fetchall():
+            _bump_daily_stats(c, start_time_str[:10], roles_granted=1)
+            _record_conversion(c, user_id, role_id, start_time_str)
+        set_state(c, 'analytics_built', clock.now().isoformat())
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+# 流式读取表数据：每次 fetchmany 一批，不一次性加载整张表
+def iter_table_batches(table, batch_size=EXPORT_BATCH_SIZE):
+    if table not in EXPORT_TABLES:
+        raise ValueError(f'不支持导出的表：{table}')
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        c.execute(f'SELECT * FROM {table}')
+        columns = [d[0] for d in c.description]
+        yield columns
+        while True:
+            rows = c.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+# 根据表的声明类型构造固定的 parquet schema（按 SQLite 类型亲和性规则），
+# 避免某一批整列为 NULL 时推断出的类型与前面的批次不一致
+def export_parquet_schema(table, columns):
+    conn = get_db()
+    declared = {row[1]: (row[2] or '').upper() for row in conn.execute(f'PRAGMA table_info({table})')}
+    conn.close()
+    fields = []
+    for name in columns:
+        decl = declared.get(name, '')
+        if 'INT' in decl:
+            arrow_type = pyarrow.int64()
+        elif any(t in decl for t in ('REAL', 'FLOA', 'DOUB')):
+            arrow_type = pyarrow.float64()
+        else:
+            arrow_type = pyarrow.string()
+        fields.append(pyarrow.field(name, arrow_type))
+    return pyarrow.schema(fields)
+
+# 导出表到文件，返回 (文件路径, 行数)
+def export_table(table, fmt='csv', out_path=None, batch_size=EXPORT_BATCH_SIZE):
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f'不支持的导出格式：{fmt}')
+    if fmt == 'parquet' and pyarrow is None:
+        raise RuntimeError('导出 parquet 需要安装 pyarrow：pip install pyarrow')
+    if out_path is None:
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        out_path = os.path.join(EXPORT_DIR, f'{table}-{datetime.now().strftime("%Y%m%d-%H%M%S")}.{fmt}')
+
+    batches = iter_table_batches(table, batch_size)
+    columns = next(batches)
+    row_count = 0
+    if fmt == 'csv':
+        with open(out_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for rows in batches:
+                writer.writerows(rows)
+                row_count += len(rows)
+    else:
+        # 每批写成一个 row group，内存占用只与批大小有关；所有批次使用同一个 schema
+        schema = export_parquet_schema(table, columns)
+        with pyarrow.parquet.ParquetWriter(out_path, schema) as writer:
+            for rows in batches:
+                batch = pyarrow.Table.from_pydict(
+                    {name: list(values) for name, values in zip(columns, zip(*rows))}, schema=schema)
+                writer.write_table(batch)
+                row_count += len(rows)
+    return out_path, row_count
+
+# 计算剩余时间
+def get_remaining_time(start_time_str):
+    if not start_time_str:
+        return None
+    start_time = datetime.fromisoformat(start_time_str)
+    end_time = start_time + timedelta(hours=CONFIG.experience_duration_hours)
+    now = clock.now()
+    if now >= end_time:
+        return None  # 已过期
+    remaining = end_time - now
+    return remaining
+
+# ========== 审计日志 ==========
+
+AUDIT_FLUSH_INTERVAL = 2.0  # 秒
+AUDIT_BATCH_SIZE = 500  # 缓冲区达到该数量时立即写入
+AUDIT_QUERY_LIMIT = 25
+
+# 审计事件按月分表（audit_events_YYYYMM），旧月份的表不会再写入，不影响当前表的写入和查询
+def audit_table_name(when):
+    return f'audit_events_{when[:4]}{when[5:7]}'
+
+_audit_tables = set()
+
+def _ensure_audit_table(c, table):
+    if table in _audit_tables:
+        return
+    c.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TEXT NOT NULL,
+            action TEXT NOT NULL,
+            user_id INTEGER,
+            role_id INTEGER,
+            actor_id INTEGER,
+            detail TEXT
+        )
+    ''')
+    c.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_user ON {table}(user_id, id)')
+    c.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_actor ON {table}(actor_id, id)')
+    _audit_tables.add(table)
+
+# 批量写入审计事件（单个事务）；events 为 (created_at, action, user_id, role_id, actor_id, detail)
+def write_audit_events(events):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        by_table = {}
+        for event in events:
+            by_table.setdefault(audit_table_name(event[0]), []).append(event)
+        for table, rows in by_table.items():
+            _ensure_audit_table(c, table)
+            c.executemany(f'''
+                INSERT INTO {table} (created_at, action, user_id, role_id, actor_id, detail)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        _audit_tables.clear()  # 建表可能随事务回滚，下次重新检查
+        raise
+    finally:
+        conn.close()
+
+# 获取所有审计分表（新的在前）
+def get_audit_tables(c):
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'audit\\_events\\_%' ESCAPE '\\'")
+    return sorted((row[0] for row in c.fetchall()), reverse=True)
+
+# 查询与用户有关（被操作或执行操作）的审计事件：从最新的月份开始，凑够 limit 条即停止
+def get_user_audit_events(user_id, limit=AUDIT_QUERY_LIMIT):
+    conn = get_db()
+    c = conn.cursor()
+    results = []
+    for table in get_audit_tables(c):
+        c.execute(f'''
+            SELECT created_at, action, user_id, role_id, actor_id, detail FROM {table}
+            WHERE user_id = ? OR actor_id = ?
+            ORDER BY id DESC
+            LIMIT ?
+        ''', (user_id, user_id, limit - len(results)))
+        results.extend(c.fetchall())
+        if len(results) >= limit:
+            break
+    conn.close()
+    return results
+
+# 审计日志追加器：record() 只写入内存缓冲区，不阻塞调用方；后台定期或缓冲区满时批量写入数据库
+class AuditLog:
+    def __init__(self, interval=AUDIT_FLUSH_INTERVAL, batch_size=AUDIT_BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._buffer = []
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def record(self, action, user_id=None, role_id=None, actor_id=None, detail=None):
+        self._buffer.append((clock.now().isoformat(), action, user_id, role_id, actor_id, detail))
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._buffer:
+                return 0
+            events, self._buffer = self._buffer, []
+            try:
+                await asyncio.to_thread(write_audit_events, events)
+            except Exception as e:
+                # 写入失败时放回缓冲区，下次重试
+                self._buffer[:0] = events
+                print(f'写入审计日志时出错：{str(e)}')
+                return 0
+            return len(events)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+audit_log = AuditLog()
+
+AUDIT_ACTION_LABELS = {
+    'trial_grant': '申请体验',
+    'role_grant': '赋予身份组',
+    'revoke': '撤销身份组',
+    'revoke_failed': '撤销失败',
+    'role_restore': '恢复身份组',
+    'role_config_add': '添加身份组配置',
+    'role_config_remove': '删除身份组配置',
+    'user_remove': '删除体验记录',
+    'config_change': '修改配置',
+}
+
+# ========== 数据库备份 ==========
+
+BACKUP_DIR = 'backups'
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', 7))  # 保留最近的快照数量
+BACKUP_INTERVAL_HOURS = float(os.getenv('BACKUP_INTERVAL_HOURS', 24))  # 0 表示不自动备份
+BACKUP_PAGES_PER_STEP = 256  # 每一步复制的页数，步与步之间释放数据库锁，正常读写可以穿插进行
+BACKUP_STEP_SLEEP = 0.005
+
+# 检查数据库文件的完整性
+def check_database_integrity(path):
+    if not os.path.isfile(path):
+        return f'文件不存在：{path}'
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('PRAGMA integrity_check').fetchone()[0]
+    except sqlite3.DatabaseError as e:
+        return str(e)
+    finally:
+        conn.close()
+
+# 使用 SQLite 在线备份接口分步复制数据库，先写入临时文件，校验通过后再改名，不会留下不完整的快照
+def backup_database(dest_path=None, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP):
+    if dest_path is None:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        name = os.path.splitext(os.path.basename(DB_PATH))[0]
+        dest_path = os.path.join(BACKUP_DIR, f'{name}-{datetime.now().strftime("%Y%m%d-%H%M%S")}.db')
+    tmp_path = f'{dest_path}.tmp'
+    src = get_db()
+    dst = sqlite3.connect(tmp_path)
+    try:
+        # 整个备份期间保持一个读事务：WAL 模式下始终复制同一个快照，其他连接的写入不会让备份重新开始
+        src.execute('BEGIN')
+        src.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        src.backup(dst, pages=pages, sleep=sleep)
+        src.rollback()
+    finally:
+        dst.close()
+        src.close()
+    result = check_database_integrity(tmp_path)
+    if result != 'ok':
+        os.remove(tmp_path)
+        raise RuntimeError(f'备份文件校验失败：{result}')
+    os.replace(tmp_path, dest_path)
+    return dest_path
+
+# 只保留最近的 keep 个快照
+def rotate_backups(keep=BACKUP_KEEP):
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    name = os.path.splitext(os.path.basename(DB_PATH))[0]
+    snapshots = sorted(f for f in os.listdir(BACKUP_DIR) if f.startswith(f'{name}-') and f.endswith('.db'))
+    removed = snapshots[:-keep] if keep > 0 else []
+    for f in removed:
+        os.remove(os.path.join(BACKUP_DIR, f))
+    return removed
+
+# 从快照恢复：先校验快照，再把当前数据库改名保留，最后写入恢复的数据（需先停止机器人）
+def restore_database(backup_path):
+    result = check_database_integrity(backup_path)
+    if result != 'ok':
+        raise RuntimeError(f'快照校验失败：{result}')
+    tmp_path = f'{DB_PATH}.restore'
+    src = sqlite3.connect(backup_path)
+    dst = sqlite3.connect(tmp_path)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+    previous = None
+    if os.path.exists(DB_PATH):
+        # 先合并 WAL 中的写入，再把原数据库整体保留下来
+        conn = sqlite3.connect(DB_PATH)
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.close()
+        previous = f'{DB_PATH}.before-restore-{datetime.now().strftime("%Y%m%d-%H%M%S")}'
+        os.replace(DB_PATH, previous)
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(DB_PATH + suffix):
+                os.remove(DB_PATH + suffix)
+    os.replace(tmp_path, DB_PATH)
+    return previous
+
+# 在后台线程执行备份，同时测量事件循环的延迟，确认备份没有阻塞交互
+async def run_backup():
+    lag = {'max': 0.0}
+    interval = 0.05
+
+    async def monitor():
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            lag['max'] = max(lag['max'], time.monotonic() - started - interval)
+
+    monitor_task = asyncio.create_task(monitor())
+    started = time.monotonic()
+    try:
+        path = await asyncio.to_thread(backup_database)
+    finally:
+        monitor_task.cancel()
+    elapsed = time.monotonic() - started
+    removed = await asyncio.to_thread(rotate_backups)
+    size = os.path.getsize(path)
+    print(f'[备份] 已写入 {path}（{size / 1024 / 1024:.1f} MB），耗时 {elapsed:.2f}s，'
+          f'事件循环最大延迟 {lag["max"] * 1000:.0f}ms，清理旧快照 {len(removed)} 个')
+    return path, size, elapsed, lag['max']
+
+# 定时任务：定期备份数据库
+@tasks.loop(hours=BACKUP_INTERVAL_HOURS or 24)
+async def backup_database_task():
+    try:
+        await run_backup()
+    except Exception as e:
+        print(f'备份数据库时出错：{str(e)}')
+
+# ========== 性能分析 ==========
+
+PROFILE_DIR = 'profiles'
+PROFILE_MAX_SECONDS = 300
+PROFILE_SIGNAL_SECONDS = int(os.getenv('PROFILE_SIGNAL_SECONDS', 30))  # 收到 SIGUSR1 时的采样时长
+PROFILE_SAMPLE_INTERVAL = 0.01  # 每 10ms 采样一次所有线程的调用栈
+PROFILE_TRACEMALLOC_FRAMES = 1  # 只记录分配发生的那一行，开销最低
+PROFILE_TOP_N = 25
+
+# 采样分析器：后台线程定期读取所有线程的调用栈并按折叠栈格式计数，
+# 不像 cProfile 那样拦截每次函数调用，也能覆盖 to_thread 中执行的数据库操作
+class SamplingProfiler:
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    # 折叠栈格式，可直接交给 flamegraph.pl / speedscope 生成火焰图
+    def write_collapsed(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                f.write(f'{stack} {count}\n')
+
+def write_allocation_report(snapshot, path, top_n=PROFILE_TOP_N):
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ])
+    stats = snapshot.statistics('lineno')
+    total = sum(stat.size for stat in stats)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f'采样窗口内分配且仍存活的内存：{total / 1024:.1f} KiB，共 {len(stats)} 处\n\n')
+        for index, stat in enumerate(stats[:top_n], 1):
+            frame = stat.traceback[0]
+            f.write(f'#{index} {frame.filename}:{frame.lineno}: {stat.size / 1024:.1f} KiB，{stat.count} 个对象\n')
+    return stats[:top_n]
+
+_profile_running = False
+
+# 在限定时间内同时开启采样分析和 tracemalloc，结束后写出折叠栈和内存分配报告
+async def capture_profile(seconds, label='manual'):
+    global _profile_running
+    if _profile_running:
+        raise RuntimeError('已有性能分析正在进行')
+    _profile_running = True
+    try:
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+        profiler = SamplingProfiler()
+        profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            await asyncio.to_thread(profiler.stop)
+            snapshot = tracemalloc.take_snapshot()
+            if started_tracing:
+                tracemalloc.stop()
+        
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        prefix = os.path.join(PROFILE_DIR, f'{label}_{datetime.now().strftime("%Y%m%d_%H%M%S")}')
+        stacks_path = f'{prefix}.collapsed'
+        alloc_path = f'{prefix}.alloc.txt'
+        await asyncio.to_thread(profiler.write_collapsed, stacks_path)
+        top_allocations = await asyncio.to_thread(write_allocation_report, snapshot, alloc_path)
+        print(f'[性能分析] 完成 {profiler.samples} 次采样，结果已写入 {stacks_path} 和 {alloc_path}')
+        return profiler, top_allocations, [stacks_path, alloc_path]
+    finally:
+        _profile_running = False
+
+async def run_signal_profile():
+    try:
+        await capture_profile(PROFILE_SIGNAL_SECONDS, label='signal')
+    except RuntimeError as e:
+        print(f'[性能分析] {str(e)}')
+
+# ========== 成员缓存策略 ==========
+
+# 选择性成员缓存：只为有记录的用户和持有相关身份组的成员保留完整的 Member 对象，
+# 其余成员只在紧凑的有序数组中记录ID。discord.py 的 MemberCacheFlags 只能按 joined/voice
+# 整体开关，因此这里直接通过 Guild._add_member/_remove_member 管理缓存
+class SelectiveMemberCache:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.tracked_users = set()
+        self.tracked_roles = set()
+        self.primed = False
+        self._others = array('Q')
+
+    def refresh(self):
+        self.tracked_users = get_tracked_user_ids()
+        self.tracked_roles = get_tracked_role_ids()
+
+    def should_cache(self, member):
+        return member.id in self.tracked_users or any(role.id in self.tracked_roles for role in member.roles)
+
+    def _add_other(self, user_id):
+        i = bisect.bisect_left(self._others, user_id)
+        if i == len(self._others) or self._others[i] != user_id:
+            self._others.insert(i, user_id)
+
+    def _discard_other(self, user_id):
+        i = bisect.bisect_left(self._others, user_id)
+        if i < len(self._others) and self._others[i] == user_id:
+            del self._others[i]
+
+    def contains(self, guild, user_id):
+        # 成员是否在服务器中（无论是否完整缓存）
+        if guild.get_member(user_id) is not None:
+            return True
+        i = bisect.bisect_left(self._others, user_id)
+        return i < len(self._others) and self._others[i] == user_id
+
+    # 建立成员列表后可以直接判断成员已不在服务器中，无需再调用接口查询
+    # 有记录的成员不在ID列表中，缓存被清空后无法判断，仍交给调用方查询接口
+    def known_absent(self, guild, user_id):
+        return (self.enabled and self.primed and user_id not in self.tracked_users
+                and not self.contains(guild, user_id))
+
+    # 重新 identify（discord.py 会清空成员缓存）或更换服务器后需要重新建立成员列表
+    def reset(self):
+        self.primed = False
+        self._others = array('Q')
+
+    # 新记录的成员未必已在缓存中，保留其在ID列表中的记录，contains 仍能判断其在服务器中
+    def track(self, user_id):
+        self.tracked_users.add(user_id)
+
+    def discard(self, user_id):
+        self._discard_other(user_id)
+
+    # 启动时分页拉取成员列表，只缓存需要的成员（不会像全量分块那样一次性缓存所有成员）
+    async def prime(self, guild):
+        if not self.enabled or self.primed:
+            return
+        self.refresh()
+        others = array('Q')
+        kept = 0
+        async for member in guild.fetch_members(limit=None):
+            if self.should_cache(member):
+                guild._add_member(member)
+                kept += 1
+            else:
+                others.append(member.id)
+        self._others = array('Q', sorted(others))
+        self.primed = True
+        print(f'成员缓存已建立：完整缓存 {kept} 人，仅记录ID {len(self._others)} 人')
+
+    # 新加入的成员默认会被 discord.py 缓存，不相关的立即移出
+    def on_join(self, member):
+        if self.enabled and not self.should_cache(member):
+            member.guild._remove_member(member)
+            self._add_other(member.id)
+
+    # discord.py 会在收到未缓存成员的更新时把成员加入缓存，定期清理
+    def prune(self, guild):
+        if not self.enabled:
+            return 0
+        self.refresh()
+        evicted = 0
+        for member in list(guild.members):
+            if member.id != bot.user.id and not self.should_cache(member):
+                guild._remove_member(member)
+                self._add_other(member.id)
+                evicted += 1
+        return evicted
+
+member_cache_policy = SelectiveMemberCache(enabled=MEMBER_CACHE_POLICY == 'selective')
+
+# 创建机器人
+intents = discord.Intents.default()
+intents.message_content = True
+intents.members = True  # 必须开启，机器人才能在后台看到所有成员
+SHUTDOWN_DRAIN_TIMEOUT = 25.0
+
+class TrialBot(commands.Bot):
+    async def setup_hook(self):
+        init_db()
+        load_config()
+        trial_slots.load()
+        # 注册持久化视图：重启后旧的 /setup 面板按钮依然可用
+        self.add_view(ExperienceView())
+        try:
+            self.loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+            # kill -USR1 <pid> 触发一次性能分析
+            self.loop.add_signal_handler(signal.SIGUSR1, lambda: asyncio.create_task(run_signal_profile()))
+        except (NotImplementedError, RuntimeError, AttributeError):
+            pass  # Windows 不支持 add_signal_handler 和 SIGUSR1
+
+    # 优雅关闭：停止接收新点击，等待进行中的赋予/撤销完成后再断开连接
+    async def close(self):
+        if interaction_pool.accepting:
+            interaction_pool.accepting = False
+            print('正在关闭：停止接收新的交互，等待进行中的任务完成...')
+            check_expired_roles.stop()
+            reconcile_pending_members.stop()
+            prune_member_cache.stop()
+            backup_database_task.stop()
+            release_expired_trial_slots.stop()
+            await interaction_pool.drain(timeout=SHUTDOWN_DRAIN_TIMEOUT)
+            try:
+                # 等待正在执行的撤销任务完成；未执行的任务留在 outbox 中，重启后继续
+                await asyncio.wait_for(_sweep_lock.acquire(), SHUTDOWN_DRAIN_TIMEOUT)
+                _sweep_lock.release()
+            except asyncio.TimeoutError:
+                print('⚠️ 等待撤销任务超时，剩余任务将在重启后继续执行')
+            for task in _background_tasks.values():
+                task.cancel()
+            # 写入缓冲区中剩余的审计事件
+            await audit_log.flush()
+            print(f'进行中的交互已处理完毕（剩余 {len(interaction_pool)} 个）')
+        await super().close()
+
+# 选择性缓存时不在启动时分块下载全部成员，改为在 on_ready 中按策略拉取
+bot = TrialBot(command_prefix='!', intents=intents, chunk_guilds_at_startup=not member_cache_policy.enabled)
+
+# 错误处理：权限不足
+@bot.tree.error
+async def on_app_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+    try:
+        if isinstance(error, app_commands.MissingPermissions):
+            if not interaction.response.is_done():
+                await interaction.response.send_message('❌ 您没有权限使用此命令！', ephemeral=True)
+            else:
+                await interaction.followup.send('❌ 您没有权限使用此命令！', ephemeral=True)
+        else:
+            # 检查交互是否已经响应
+            if not interaction.response.is_done():
+                await interaction.response.send_message(f'❌ 发生错误：{str(error)}', ephemeral=True)
+            else:
+                # 如果已经响应过，使用 followup
+                await interaction.followup.send(f'❌ 发生错误：{str(error)}', ephemeral=True)
+    except discord.errors.NotFound:
+        # 交互已过期，无法响应
+        print(f'⚠️ 交互已过期，无法发送错误消息：{str(error)}')
+    except Exception as e:
+        print(f'❌ 错误处理时发生异常：{str(e)}')
+        import traceback
+        traceback.print_exc()
+
+# ========== 快速应答交互 ==========
+
+INTERACTION_ACK_DEADLINE = 3.0  # Discord 要求 3 秒内应答
+INTERACTION_TOKEN_LIFETIME = 15 * 60  # 交互令牌有效期，超过后无法发送 followup
+INTERACTION_POOL_SIZE = 32
+INTERACTION_WORK_TIMEOUT = 60.0
+
+# 交互任务池：立即 defer 应答，实际的身份组/数据库操作在有界任务池中执行，结果通过 followup 发送
+class InteractionPool:
+    def __init__(self, size=INTERACTION_POOL_SIZE, timeout=INTERACTION_WORK_TIMEOUT):
+        self.timeout = timeout
+        self.accepting = True
+        self._semaphore = asyncio.Semaphore(size)
+        self._tasks = set()
+        self.stats = {'acked': 0, 'expired': 0, 'completed': 0, 'timed_out': 0, 'failed': 0}
+        self.max_ack_latency = 0.0
+
+    def __len__(self):
+        return len(self._tasks)
+
+    @staticmethod
+    def age(interaction):
+        return (discord.utils.utcnow() - interaction.created_at).total_seconds()
+
+    async def submit(self, interaction, work, ephemeral=True, thinking=True):
+        if not self.accepting:
+            # 正在关闭，不再接收新的操作
+            try:
+                await interaction.response.send_message('⚠️ 机器人正在重启，请稍后再试', ephemeral=True)
+            except discord.HTTPException:
+                pass
+            return
+        try:
+            await interaction.response.defer(ephemeral=ephemeral, thinking=thinking)
+        except discord.NotFound:
+            # 应答前交互就已过期，不再执行后续操作
+            self.stats['expired'] += 1
+            print(f'⚠️ 交互已过期（已等待 {self.age(interaction):.2f} 秒），跳过处理')
+            return
+        ack_latency = self.age(interaction)
+        self.stats['acked'] += 1
+        self.max_ack_latency = max(self.max_ack_latency, ack_latency)
+
+        task = asyncio.create_task(self._execute(interaction, work, ephemeral))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, interaction, work, ephemeral):
+        async with self._semaphore:
+            # 超时时间不超过交互令牌的剩余有效期（留 5 秒发送结果）
+            timeout = min(self.timeout, INTERACTION_TOKEN_LIFETIME - self.age(interaction) - 5)
+            try:
+                result = await asyncio.wait_for(work(), max(timeout, 0))
+                self.stats['completed'] += 1
+            except asyncio.TimeoutError:
+                self.stats['timed_out'] += 1
+                result = '❌ 处理超时，请稍后再试'
+            except Exception as e:
+                self.stats['failed'] += 1
+                print(f'❌ 处理交互时出错：{str(e)}')
+                result = f'❌ 发生错误：{str(e)}'
+
+            if result is None:
+                return
+            kwargs = result if isinstance(result, dict) else {'content': result}
+            try:
+                await interaction.followup.send(ephemeral=ephemeral, **kwargs)
+            except discord.HTTPException as e:
+                print(f'❌ 发送交互结果时出错：{str(e)}')
+
+    async def drain(self, timeout=None):
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+interaction_pool = InteractionPool()
+
+# 翻页视图
+class PaginatedView(discord.ui.View):
+    def __init__(self, pages, initial_page=0, build_page=None):
+        super().__init__(timeout=300)  # 5分钟超时
+        # build_page 不为空时按需生成页面：pages 只需给出页数（未生成的页为 None）
+        self.pages = pages
+        self.build_page = build_page
+        self.current_page = initial_page
+        self.max_page = len(pages) - 1
+        self.update_buttons()
+    
+    @classmethod
+    async def create(cls, page_count, build_page):
+        view = cls([None] * page_count, build_page=build_page)
+        await view.get_page(0)
+        return view
+    
+    async def get_page(self, index):
+        if self.pages[index] is None:
+            self.pages[index] = await self.build_page(index)
+        return self.pages[index]
+    
+    async def show_page(self, interaction):
+        self.update_buttons()
+        if self.pages[self.current_page] is not None:
+            await interaction.response.edit_message(embed=self.pages[self.current_page], view=self)
+            return
+        # 生成页面可能需要查询成员名字，先应答交互
+        await interaction.response.defer()
+        embed = await self.get_page(self.current_page)
+        await interaction.edit_original_response(embed=embed, view=self)
+    
+    def update_buttons(self):
+        # 清除所有按钮
+        self.clear_items()
+        
+        # 上一页按钮
+        prev_button = discord.ui.Button(
+            label='上一页',
+            style=discord.ButtonStyle.primary,
+            emoji='◀️',
+            disabled=self.current_page == 0
+        )
+        prev_button.callback = self.previous_page
+        self.add_item(prev_button)
+        
+        # 页码显示
+        page_button = discord.ui.Button(
+            label=f'{self.current_page + 1}/{self.max_page + 1}',
+            style=discord.ButtonStyle.secondary,
+            disabled=True
+        )
+        self.add_item(page_button)
+        
+        # 下一页按钮
+        next_button = discord.ui.Button(
+            label='下一页',
+            style=discord.ButtonStyle.primary,
+            emoji='▶️',
+            disabled=self.current_page >= self.max_page
+        )
+        next_button.callback = self.next_page
+        self.add_item(next_button)
+    
+    async def previous_page(self, interaction: discord.Interaction):
+        if self.current_page > 0:
+            self.current_page -= 1
+            await self.show_page(interaction)
+    
+    async def next_page(self, interaction: discord.Interaction):
+        if self.current_page < self.max_page:
+            self.current_page += 1
+            await self.show_page(interaction)
+
+# 按钮视图
+class ExperienceView(discord.ui.View):
+    def __init__(self):
+        super().__init__(timeout=None)
+    
+    @discord.ui.button(label='申请体验', style=discord.ButtonStyle.primary, emoji='✨', custom_id='experience:apply')
+    async def apply_experience(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction_pool.submit(interaction, lambda: apply_experience_work(interaction))
+    
+    @discord.ui.button(label='查询时长', style=discord.ButtonStyle.secondary, emoji='⏰', custom_id='experience:check_time')
+    async def check_time(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction_pool.submit(interaction, lambda: check_time_work(interaction))
+
+# 申请体验：返回要发送给用户的消息
+async def apply_experience_work(interaction: discord.Interaction):
+    user_id = interaction.user.id
+    user_info = await asyncio.to_thread(get_user_info, user_id)
+    
+    # 检查是否已经使用过
+    if user_info and user_info[1] == 1:
+        return '❌ 您已经使用过体验机会了，每个会员只能获得一次体验机会！'
+    
+    # 检查是否正在体验中
+    if user_info and user_info[0]:
+        remaining = get_remaining_time(user_info[0])
+        if remaining:
+            total_seconds = int(remaining.total_seconds())
+            hours = total_seconds // 3600
+            minutes = (total_seconds % 3600) // 60
+            return f'⚠️ 您正在体验中，剩余时间：{hours}小时{minutes}分钟'
+    
+    # 赋予身份组
+    guild = interaction.guild
+    role = guild.get_role(CONFIG.vip_role_id)
+    if not role:
+        return '❌ 错误：找不到会员身份组，请检查配置！'
+    
+    # 名额已满时加入等候队列
+    if not trial_slots.acquire(user_id, clock.now() + timedelta(hours=CONFIG.experience_duration_hours)):
+        position = await trial_slots.join_waitlist(user_id)
+        return (
+            f'⏳ 当前体验名额已满（{CONFIG.trial_capacity} 人），您已加入等候队列，排在第 {position} 位\n'
+            f'有名额空出时会自动为您开通体验并私信通知您'
+        )
+    
+    # 开通失败（包括任务被取消）时必须释放名额，否则名额会一直被占用到进程重启
+    try:
+        end_time = await start_trial(interaction.user, role, actor_id=user_id)
+    except discord.Forbidden:
+        trial_slots.release(user_id)
+        return '❌ 错误：机器人没有权限赋予身份组！'
+    except BaseException:
+        trial_slots.release(user_id)
+        raise
+    
+    return (
+        f'✅ 体验权限已激活！\n'
+        f'⏰ 体验时长：{format_duration_hours(CONFIG.experience_duration_hours)}\n'
+        f'📅 到期时间：{end_time.strftime("%Y-%m-%d %H:%M:%S")}\n'
+        f'⚠️ 时间结束后，权限将自动移除'
+    )
+
+# 查询时长：返回要发送给用户的消息
+async def check_time_work(interaction: discord.Interaction):
+    user_id = interaction.user.id
+    user_info = await asyncio.to_thread(get_user_info, user_id)
+    
+    if not user_info or not user_info[0]:
+        position = trial_slots.position(user_id)
+        if position:
+            return f'⏳ 您正在等候体验名额，当前排在第 {position} 位'
+        return '❌ 您还没有申请体验权限！'
+    
+    remaining = get_remaining_time(user_info[0])
+    if not remaining:
+        # 如果已过期，立即移除身份组
+        guild = interaction.guild
+        role = guild.get_role(CONFIG.vip_role_id)
+        if not role:
+            return '⏰ 您的体验时间已结束！但找不到会员身份组，请通知管理员。'
+        
+        member = guild.get_member(user_id)
+        if not member:
+            return '⏰ 您的体验时间已结束！'
+        
+        if role not in member.roles:
+            # 用户已经没有身份组了
+            return '⏰ 您的体验时间已结束！身份组已被移除。'
+        
+        # 用户还有身份组，需要移除
+        try:
+            await member.remove_roles(role)
+            print(f'✅ [查询时长] 已移除用户 {member.name} ({user_id}) 的体验权限')
+            return '⏰ 您的体验时间已结束！身份组已自动移除。'
+        except discord.Forbidden:
+            print(f'❌ [查询时长] 权限不足：无法移除用户 {member.name} ({user_id}) 的身份组')
+            print('   提示：确保机器人的身份组在服务器身份组列表中位于会员身份组之上')
+            return (
+                '⏰ 您的体验时间已结束！\n'
+                '❌ 但移除身份组时权限不足，请通知管理员检查机器人权限。'
+            )
+        except Exception as e:
+            print(f'❌ [查询时长] 移除用户 {member.name} ({user_id}) 权限时出错：{str(e)}')
+            import traceback
+            traceback.print_exc()
+            return (
+                f'⏰ 您的体验时间已结束！\n'
+                f'❌ 但移除身份组时出错：{str(e)}\n'
+                f'请通知管理员。'
+            )
+    else:
+        total_seconds = int(remaining.total_seconds())
+        hours = total_seconds // 3600
+        minutes = (total_seconds % 3600) // 60
+        seconds = total_seconds % 60
+        start_time = datetime.fromisoformat(user_info[0])
+        end_time = start_time + timedelta(hours=CONFIG.experience_duration_hours)
+        
+        return (
+            f'⏰ **剩余体验时间**\n'
+            f'📅 开始时间：{start_time.strftime("%Y-%m-%d %H:%M:%S")}\n'
+            f'📅 到期时间：{end_time.strftime("%Y-%m-%d %H:%M:%S")}\n'
+            f'⏳ 剩余时长：{hours}小时{minutes}分钟{seconds}秒'
+        )
+
+# 移除单个用户的过期权限
+async def remove_expired_role(user_id, guild, role):
+    """移除单个用户的过期权限"""
     try:
         member = guild.get_member(user_id)
         if not member:
@@ -456,121 +2028,819 @@ async def remove_expired_role(user_id, guild, role):
         traceback.print_exc()
         return False
 
+# 网关撤销器：通过成员缓存（缓存未命中时走接口）移除身份组
+class GatewayRevoker:
+    def __init__(self, guild):
+        self.guild = guild
+
+    async def revoke(self, user_id, role_id):
+        role = self.guild.get_role(role_id)
+        if not role:
+            return 'role_missing'
+
+        # 先从缓存获取
+        member = self.guild.get_member(user_id)
+        if member is None:
+            if member_cache_policy.known_absent(self.guild, user_id):
+                return 'left'
+            try:
+                # 如果缓存里没有，尝试从API获取（兜底方案）
+                member = await self.guild.fetch_member(user_id)
+            except discord.NotFound:
+                return 'left'
+
+        # 已经没有该身份组时不再调用接口，重启后重复执行也不会产生多余请求
+        if role not in member.roles:
+            return 'absent'
+
+        await member.remove_roles(role, reason='体验/身份组已到期')
+        print(f'✅ [定时任务] 已移除用户 {member.name} ({user_id}) 的身份组 {role.name}')
+        return 'removed'
+
+    # 撤销期间记录被续期时补发刚移除的身份组
+    async def restore(self, user_id, role_id):
+        await self.guild._state.http.add_role(self.guild.id, user_id, role_id, reason='撤销期间身份组已续期')
+
+# 接口撤销器：只使用 HTTP 接口，不需要网关连接和成员缓存
+# 移除身份组的接口是幂等的（用户没有该身份组时也返回成功），因此无需先查询成员
+class RestRevoker:
+    def __init__(self, http, guild_id):
+        self.http = http
+        self.guild_id = guild_id
+
+    async def revoke(self, user_id, role_id):
+        try:
+            await self.http.remove_role(self.guild_id, user_id, role_id, reason='体验/身份组已到期')
+        except discord.NotFound as e:
+            # 10011: 身份组不存在；10007: 用户已离开服务器
+            return 'role_missing' if e.code == 10011 else 'left'
+        print(f'✅ [expire-worker] 已移除用户 {user_id} 的身份组 {role_id}')
+        return 'removed'
+
+    async def restore(self, user_id, role_id):
+        await self.http.add_role(self.guild_id, user_id, role_id, reason='撤销期间身份组已续期')
+
+# 撤销期间记录被续期：身份组已经移除，但有效记录被保留，需要补发身份组
+async def restore_revoked_role(revoker, user_id, role_id):
+    try:
+        await revoker.restore(user_id, role_id)
+    except Exception as e:
+        print(f'❌ 用户 {user_id} 的身份组 {role_id} 在撤销期间被续期，补发身份组失败：{str(e)}；请手动重新赋予')
+        return
+    audit_log.record('role_restore', user_id, role_id, detail='撤销期间记录被续期')
+    print(f'⚠️ 用户 {user_id} 的身份组 {role_id} 在撤销期间被续期，已重新赋予')
+
+# 执行单个撤销任务
+async def execute_revocation(revoker, job, stats):
+    job_id, kind, user_id, role_id, record_id, due_time, attempts = job
+    try:
+        if not is_revocation_still_due(kind, user_id, role_id, record_id, due_time):
+            # 记录已被续期或重新申请，取消任务
+            outcome = 'superseded'
+            complete_revocation(job_id, kind, record_id, outcome, status='cancelled')
+        else:
+            revoked = await revoker.revoke(user_id, role_id)
+            outcome = complete_revocation(job_id, kind, record_id, revoked, due_time=due_time)
+            if outcome == 'superseded' and revoked == 'removed':
+                await restore_revoked_role(revoker, user_id, role_id)
+            if kind == 'experience':
+                trial_slots.release(user_id)
+        audit_log.record('revoke', user_id, role_id, detail=f'{kind}: {outcome}（到期时间 {due_time}）')
+    except Exception as e:
+        outcome = 'error'
+        fail_revocation(job_id, str(e))
+        audit_log.record('revoke_failed', user_id, role_id, detail=f'{kind}: {str(e)}')
+        if isinstance(e, discord.Forbidden):
+            print(f'❌ [定时任务] 权限不足：无法移除用户 {user_id} 的身份组 {role_id}（任务ID: {job_id}）')
+            print('   提示：确保机器人的身份组在服务器身份组列表中位于会员身份组之上')
+        else:
+            print(f'❌ [定时任务] 移除用户 {user_id} 身份组 {role_id} 时出错（任务ID: {job_id}）：{str(e)}')
+    stats[outcome] = stats.get(outcome, 0) + 1
+
+# 执行所有待撤销任务（多个 worker 并发消费）
+# 每个 worker 在执行前才领取一个任务，租约只需覆盖单个任务的执行时间；
+# 本轮只向后领取（id 递增），失败后放回的任务留到下一轮重试
+async def run_revocation_jobs(revoker, workers=4):
+    stats = {}
+    after_id = 0
+
+    async def worker():
+        nonlocal after_id
+        while True:
+            jobs = claim_revocations(after_id, 1)
+            if not jobs:
+                return
+            after_id = max(after_id, jobs[0][0])
+            await execute_revocation(revoker, jobs[0], stats)
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    return stats
+
+_sweep_lock = asyncio.Lock()
+
+# 一次完整的过期处理：先批量写入任务，再执行
+async def run_expiry_sweep(revoker, workers=4):
+    async with _sweep_lock:
+        enqueued = enqueue_due_revocations(CONFIG.vip_role_id)
+        stats = await run_revocation_jobs(revoker, workers=workers)
+        # 本轮的撤销记录在一个事务中写入审计日志（独立的 expire-worker 进程也依赖这里写入）
+        await audit_log.flush()
+    return enqueued, stats
+
+# 格式化执行结果
+def format_revocation_stats(stats):
+    return '，'.join(f'{outcome}: {count}' for outcome, count in sorted(stats.items())) or '无'
+
+# 对账：对比数据库记录与实际身份组持有者，漂移通过撤销任务修复
+# user_ids 为 None 时做全量对账，否则只对账这些用户
+async def reconcile_roles(guild, user_ids=None):
+    report = {}
+    pairs = []
+    members = None
+    prune_role_grants()
+    if user_ids is not None:
+        members = [m for m in (guild.get_member(user_id) for user_id in user_ids) if m is not None]
+
+    for role_id in get_tracked_role_ids():
+        role = guild.get_role(role_id)
+        if not role:
+            continue
+
+        if members is None:
+            holders = {m.id for m in role.members}
+        else:
+            holders = {m.id for m in members if role in m.roles}
+
+        entitled, expired = load_role_entitlements(role_id, user_ids)
+        grants = load_role_grants(role_id, user_ids)
+        drift, missing, untracked = diff_role_membership(holders, entitled, expired, grants)
+        pairs.extend((user_id, role_id) for user_id in drift)
+        report[role_id] = {
+            'holders': len(holders),
+            'drift': len(drift),
+            'missing': len(missing),
+            'untracked': len(untracked),
+        }
+
+    enqueued = enqueue_reconcile_revocations(pairs)
+    stats = {}
+    if enqueued:
+        _, stats = await run_expiry_sweep(GatewayRevoker(guild))
+    return report, enqueued, stats
+
 # 定时任务：检查并移除过期权限
 @tasks.loop(minutes=1)
 async def check_expired_roles():
     try:
-        guild = bot.get_guild(GUILD_ID)
+        guild = bot.get_guild(CONFIG.guild_id)
         if not guild:
             return
-        
-        # 检查体验会员（原有功能）
-        if VIP_ROLE_ID:
-            role = guild.get_role(VIP_ROLE_ID)
-            if role:
-                conn = sqlite3.connect('vip_experience.db')
-                c = conn.cursor()
-                c.execute('SELECT user_id, start_time FROM user_experience WHERE used = 1')
-                users = c.fetchall()
-                conn.close()
-                
-                for user_id, start_time_str in users:
-                    if not start_time_str:
-                        continue
-                    
-                    remaining = get_remaining_time(start_time_str)
-                    if remaining is None:  # 已过期
-                        # 先从缓存获取
-                        member = guild.get_member(user_id)
-                        if member is None:
-                            try:
-                                # 如果缓存里没有，尝试从API获取（兜底方案）
-                                member = await guild.fetch_member(user_id)
-                            except discord.NotFound:
-                                print(f'⚠️ 用户 {user_id} 已离开服务器，跳过移除')
-                                continue
-                            except Exception as e:
-                                print(f'❌ 获取用户 {user_id} 失败: {e}')
-                                continue
-                        
-                        # 此时 member 一定不为 None
-                        if role in member.roles:
-                            try:
-                                await member.remove_roles(role)
-                                print(f'✅ [定时任务] 已移除用户 {member.name} ({user_id}) 的体验权限')
-                            except discord.Forbidden:
-                                print(f'❌ [定时任务] 权限不足：无法移除用户 {member.name} ({user_id}) 的身份组')
-                            except Exception as e:
-                                print(f'❌ [定时任务] 移除用户 {member.name} ({user_id}) 权限时出错：{str(e)}')
-        
-        # 检查手动赋予的身份组
-        active_roles = get_all_active_user_roles()
-        now = datetime.now()
-        
-        for record in active_roles:
-            record_id, user_id, role_id, start_time_str, end_time_str, duration_days, role_name = record
-            end_time = datetime.fromisoformat(end_time_str)
-            
-            if now >= end_time:  # 已过期
+
+        enqueued, stats = await run_expiry_sweep(GatewayRevoker(guild))
+        if enqueued or stats:
+            print(f'[定时任务] 新增 {enqueued} 个撤销任务，执行结果：{format_revocation_stats(stats)}')
+    except Exception as e:
+        print(f'检查过期权限时出错：{str(e)}')
+
+RECONCILE_DEBOUNCE_SECONDS = 30
+_reconcile_pending = set()
+
+# 成员身份组变化时记录下来，稍后批量对账（给赋予身份组后的数据库写入留出时间）
+@bot.event
+async def on_member_update(before, after):
+    if before.guild.id != CONFIG.guild_id:
+        return
+    if after.id in member_index and (before.display_name, before.name) != (after.display_name, after.name):
+        member_index.update_member(after)
+    before_roles = {r.id for r in before.roles}
+    after_roles = {r.id for r in after.roles}
+    tracked = get_tracked_role_ids()
+    granted = (after_roles - before_roles) & tracked
+    if granted:
+        await asyncio.to_thread(note_role_granted, after.id, granted)
+    if (before_roles ^ after_roles) & tracked:
+        _reconcile_pending.add(after.id)
+
+# 有记录的用户重新加入服务器时刷新索引中的名字
+@bot.event
+async def on_member_join(member):
+    if member.guild.id != CONFIG.guild_id:
+        return
+    if member.id in member_index:
+        member_index.update_member(member)
+    member_cache_policy.on_join(member)
+
+@bot.event
+async def on_raw_member_remove(payload):
+    if payload.guild_id == CONFIG.guild_id:
+        member_cache_policy.discard(payload.user.id)
+
+# 定时任务：把被 discord.py 自动加入缓存的无关成员移出
+@tasks.loop(minutes=10)
+async def prune_member_cache():
+    guild = bot.get_guild(CONFIG.guild_id)
+    if guild and member_cache_policy.primed:
+        evicted = member_cache_policy.prune(guild)
+        if evicted:
+            print(f'[成员缓存] 已移出 {evicted} 个无关成员')
+
+# 定时任务：增量对账最近身份组发生变化的成员
+@tasks.loop(seconds=RECONCILE_DEBOUNCE_SECONDS)
+async def reconcile_pending_members():
+    if not _reconcile_pending:
+        return
+    user_ids = set(_reconcile_pending)
+    _reconcile_pending.clear()
+    try:
+        guild = bot.get_guild(CONFIG.guild_id)
+        if not guild:
+            return
+        report, enqueued, stats = await reconcile_roles(guild, user_ids)
+        if enqueued:
+            print(f'[对账] {len(user_ids)} 个成员中发现 {enqueued} 处漂移，执行结果：{format_revocation_stats(stats)}')
+    except Exception as e:
+        print(f'增量对账时出错：{str(e)}')
+
+# ========== 到期提醒 ==========
+
+EXPIRY_NOTICE_THRESHOLDS = [('24h', timedelta(hours=24)), ('1h', timedelta(hours=1))]
+DM_SEND_INTERVAL_SECONDS = 1.0
+DM_MAX_ATTEMPTS = 3
+
+# 截止时间调度器：最小堆 + 唤醒事件，只在下一个截止时间到来时醒来
+class DeadlineScheduler:
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    def schedule(self, key, when, payload=None):
+        # 同一个 key 重新调度时，旧条目在出堆时被丢弃
+        seq = next(self._seq)
+        self._entries[key] = seq
+        heapq.heappush(self._heap, (when, seq, key, payload))
+        self._wakeup.set()
+
+    def cancel(self, key):
+        self._entries.pop(key, None)
+
+    def keys(self):
+        return list(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop_stale(self):
+        while self._heap and self._entries.get(self._heap[0][2]) != self._heap[0][1]:
+            heapq.heappop(self._heap)
+
+    def pop_due(self, now):
+        due = []
+        self._drop_stale()
+        while self._heap and self._heap[0][0] <= now:
+            when, seq, key, payload = heapq.heappop(self._heap)
+            del self._entries[key]
+            due.append((key, when, payload))
+            self._drop_stale()
+        return due
+
+    def next_time(self):
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    async def run(self, handler):
+        while True:
+            self._wakeup.clear()
+            for key, when, payload in self.pop_due(clock.now()):
                 try:
-                    role_obj = guild.get_role(role_id)
-                    if not role_obj:
-                        # 身份组不存在，删除记录
-                        delete_user_role(record_id)
-                        print(f'身份组 {role_id} 不存在，已删除记录（记录ID: {record_id}）')
-                        continue
-                    
-                    # 先从缓存获取
-                    member = guild.get_member(user_id)
-                    if member is None:
-                        try:
-                            # 如果缓存里没有，尝试从API获取（兜底方案）
-                            member = await guild.fetch_member(user_id)
-                        except discord.NotFound:
-                            # 用户已离开服务器，删除记录
-                            delete_user_role(record_id)
-                            print(f'用户 {user_id} 已离开服务器，已删除记录（记录ID: {record_id}）')
-                            continue
-                        except Exception as e:
-                            print(f'❌ 获取用户 {user_id} 失败: {e}')
-                            continue
-                    
-                    # 此时 member 一定不为 None
-                    if role_obj in member.roles:
-                        try:
-                            await member.remove_roles(role_obj)
-                            delete_user_role(record_id)
-                            print(f'✅ [定时任务] 已移除用户 {member.name} ({user_id}) 的身份组 {role_name or role_id}（记录ID: {record_id}）')
-                        except discord.Forbidden:
-                            print(f'❌ [定时任务] 权限不足：无法移除用户 {member.name} ({user_id}) 的身份组 {role_id}')
-                        except Exception as e:
-                            print(f'❌ [定时任务] 移除用户 {member.name} ({user_id}) 身份组 {role_id} 时出错：{str(e)}')
-                    else:
-                        # 用户没有身份组，删除记录
-                        delete_user_role(record_id)
-                        print(f'用户 {member.name} ({user_id}) 没有身份组 {role_id}，已删除记录（记录ID: {record_id}）')
+                    await handler(key, when, payload)
                 except Exception as e:
-                    print(f'❌ 处理用户 {user_id} 身份组 {role_id} 时出错：{str(e)}')
-                    import traceback
-                    traceback.print_exc()
+                    print(f'❌ 处理定时事件 {key} 时出错：{str(e)}')
+            next_time = self.next_time()
+            timeout = None if next_time is None else max(0, (next_time - clock.now()).total_seconds())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+# 私信发送队列：限速、去重，发送状态写入数据库
+class DMQueue:
+    def __init__(self, interval=DM_SEND_INTERVAL_SECONDS):
+        self.interval = interval
+        self._queue = asyncio.Queue()
+        self._keys = set()
+
+    def put(self, key, user_id, content, attempts=0):
+        if key in self._keys:
+            return False
+        self._keys.add(key)
+        self._queue.put_nowait((key, user_id, content, attempts))
+        return True
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    async def run(self, client):
+        while True:
+            key, user_id, content, attempts = await self._queue.get()
+            self._keys.discard(key)
+            try:
+                user = client.get_user(user_id) or await client.fetch_user(user_id)
+                await user.send(content)
+                set_expiry_notice_status(key, 'sent')
+            except (discord.Forbidden, discord.NotFound):
+                # 用户关闭了私信或账号不存在，不再重试
+                set_expiry_notice_status(key, 'failed')
+            except Exception as e:
+                if attempts + 1 < DM_MAX_ATTEMPTS:
+                    self.put(key, user_id, content, attempts + 1)
+                else:
+                    set_expiry_notice_status(key, 'failed')
+                print(f'❌ 发送到期提醒给用户 {user_id} 失败：{str(e)}')
+            await asyncio.sleep(self.interval)
+
+expiry_scheduler = DeadlineScheduler()
+dm_queue = DMQueue()
+
+# 为一个截止时间安排各档提醒（授予时长短于提醒档位的跳过）
+def schedule_expiry_notices(kind, user_id, role_id, start_time, deadline):
+    for label, delta in EXPIRY_NOTICE_THRESHOLDS:
+        key = (kind, user_id, role_id, label)
+        notify_at = deadline - delta
+        if notify_at <= start_time:
+            expiry_scheduler.cancel(key)
+            continue
+        expiry_scheduler.schedule(key, notify_at, deadline)
+
+# 提醒到点：确认截止时间未变后放入私信队列
+async def send_expiry_notice(key, notify_at, deadline):
+    kind, user_id, role_id, label = key
+    if clock.now() >= deadline or get_current_deadline(kind, user_id, role_id) != deadline:
+        return
+    notice_key = (kind, user_id, role_id, deadline.isoformat(), label)
+    if not claim_expiry_notice(*notice_key):
+        return
+
+    remaining = '24 小时' if label == '24h' else '1 小时'
+    if kind == 'experience':
+        subject = '体验会员权限'
+    else:
+        config = get_role_config(role_id)
+        subject = f'身份组「{config[1]}」' if config and config[1] else '身份组'
+    dm_queue.put(notice_key, user_id, (
+        f'⏰ 您的{subject}将在 {remaining}内到期\n'
+        f'📅 到期时间：{deadline.strftime("%Y-%m-%d %H:%M:%S")}\n'
+        f'⚠️ 到期后权限将自动移除'
+    ))
+
+# 等候队列开通体验的私信内容
+def build_promotion_notice(guild_name, end_time):
+    return (
+        f'🎉 您在 **{guild_name}** 排队的体验名额已到，已为您开通体验会员！\n'
+        f'⏰ 体验时长：{format_duration_hours(CONFIG.experience_duration_hours)}\n'
+        f'📅 到期时间：{end_time.strftime("%Y-%m-%d %H:%M:%S")}'
+    )
+
+# 启动时从数据库加载所有未到期的截止时间，以及重启前尚未发出的开通通知
+def load_expiry_notices():
+    prune_expiry_notices()
+    for kind, user_id, role_id, start_time, deadline in get_active_deadlines():
+        schedule_expiry_notices(kind, user_id, role_id, start_time, deadline)
+    guild = bot.get_guild(CONFIG.guild_id)
+    for user_id, role_id, deadline, threshold in get_queued_notices('waitlist'):
+        dm_queue.put(('waitlist', user_id, role_id, deadline, threshold), user_id,
+                     build_promotion_notice(guild.name if guild else '服务器', datetime.fromisoformat(deadline)))
+    print(f'已加载 {len(expiry_scheduler)} 个到期提醒')
+
+# 按当前配置重新安排体验会员的到期提醒
+def reschedule_experience_notices():
+    for key in expiry_scheduler.keys():
+        if key[0] == 'experience':
+            expiry_scheduler.cancel(key)
+    for kind, user_id, role_id, start_time, deadline in get_active_deadlines():
+        if kind == 'experience':
+            schedule_expiry_notices(kind, user_id, role_id, start_time, deadline)
+
+# 配置变更后立即生效：重排截止时间、回退扫描水位、使面板缓存失效
+def apply_config_change(old, new):
+    if (old.experience_duration_hours, old.vip_role_id) != (new.experience_duration_hours, new.vip_role_id):
+        rewind_experience_watermark(new.experience_duration_hours)
+        reschedule_experience_notices()
+    if old.guild_id != new.guild_id:
+        guild = bot.get_guild(new.guild_id)
+        member_cache_policy.reset()
+        if guild:
+            start_background_task('member_cache_prime', lambda: prime_member_cache(guild))
+        rebuild_member_index(guild)
+    if old.experience_duration_hours != new.experience_duration_hours:
+        trial_slots.reload_active()
+    elif old.trial_capacity != new.trial_capacity:
+        trial_slots.schedule_promotion()
+    invalidate_setup_embed()
+
+# 修改配置项并热更新
+def update_config(key, raw_value):
+    value = parse_config_value(key, raw_value)
+    old = CONFIG
+    # 先确认新配置可用再写入数据库
+    validate_config(old._replace(**{key: value}))
+    # 进行中的体验持有的是旧的会员身份组，换成新身份组后到期任务将无法撤销旧身份组
+    if key == 'vip_role_id' and value != old.vip_role_id:
+        active = get_active_trials()
+        if active:
+            raise ValueError(f'当前有 {len(active)} 个进行中的体验持有旧的会员身份组，请等全部体验到期后再修改 vip_role_id')
+    save_config_value(key, value)
+    new = load_config()
+    apply_config_change(old, new)
+    return old, new
+
+# ========== 体验名额 ==========
+
+# 体验名额：内存中记录进行中的体验（用户ID -> 到期时间），申请时直接判断是否有空位，不扫描数据库
+# 名额已满时加入先进先出的等候队列（同时写入数据库，重启后恢复），有名额空出时按顺序为等候的用户开通
+class TrialSlots:
+    def __init__(self):
+        self.active = {}
+        self.waitlist = deque()
+        self._waiting = set()
+        self.loaded = False
+
+    def __len__(self):
+        return len(self.active)
+
+    def load(self):
+        self.active = dict(get_active_trials())
+        self.waitlist = deque(get_waitlist())
+        self._waiting = set(self.waitlist)
+        self.loaded = True
+
+    # 体验时长修改后按新时长重新计算到期时间
+    def reload_active(self):
+        self.active = dict(get_active_trials())
+        self.schedule_promotion()
+
+    def has_free_slot(self):
+        return not CONFIG.trial_capacity or len(self.active) < CONFIG.trial_capacity
+
+    # 占用一个名额；有人排队时新的申请不能插队
+    def acquire(self, user_id, deadline, from_waitlist=False):
+        if user_id not in self.active:
+            if not self.has_free_slot() or (self.waitlist and not from_waitlist):
+                return False
+        self.active[user_id] = deadline
+        return True
+
+    def release(self, user_id):
+        if self.active.pop(user_id, None) is not None:
+            self.schedule_promotion()
+
+    # 释放已到期的名额（撤销由独立进程执行时，机器人靠这里得知名额空出）
+    def expire(self, now):
+        expired = [user_id for user_id, deadline in self.active.items() if deadline <= now]
+        for user_id in expired:
+            del self.active[user_id]
+        self.schedule_promotion()
+        return len(expired)
+
+    def position(self, user_id):
+        if user_id not in self._waiting:
+            return None
+        return self.waitlist.index(user_id) + 1
+
+    # 加入等候队列，返回排队位置
+    async def join_waitlist(self, user_id):
+        if user_id not in self._waiting:
+            await asyncio.to_thread(add_to_waitlist, user_id)
+            self.waitlist.append(user_id)
+            self._waiting.add(user_id)
+        return self.position(user_id)
+
+    def schedule_promotion(self):
+        if self.loaded and self.waitlist and self.has_free_slot():
+            start_background_task('trial_promotion', self.promote)
+
+    # 有空位时按顺序为等候的用户开通体验
+    # 在任何等待之前先占用名额，期间直接申请的用户不会抢走这个空位；
+    # 开通成功（或无需开通）后才删除数据库中的排队记录，失败时放回队首，下次有名额时重试
+    async def promote(self):
+        while self.waitlist:
+            user_id = self.waitlist[0]
+            if not self.acquire(user_id, clock.now() + timedelta(hours=CONFIG.experience_duration_hours), from_waitlist=True):
+                return
+            self.waitlist.popleft()
+            self._waiting.discard(user_id)
+            try:
+                granted = await promote_waitlisted_user(user_id)
+            except BaseException as e:
+                self.active.pop(user_id, None)
+                self.waitlist.appendleft(user_id)
+                self._waiting.add(user_id)
+                if not isinstance(e, Exception):
+                    raise
+                print(f'❌ 为等候队列中的用户 {user_id} 开通体验时出错：{str(e)}')
+                return
+            if not granted:
+                self.active.pop(user_id, None)
+            await asyncio.to_thread(remove_from_waitlist, user_id)
+
+trial_slots = TrialSlots()
+
+# 开通体验：赋予会员身份组并写入记录，返回到期时间（调用方需先占用名额）
+async def start_trial(member, role, actor_id=None):
+    await member.add_roles(role)
+    start_time = clock.now().isoformat()
+    await asyncio.to_thread(save_user_info, member.id, start_time, used=1)
+    await asyncio.to_thread(record_trial_started, member.id, start_time)
+    start = datetime.fromisoformat(start_time)
+    end_time = start + timedelta(hours=CONFIG.experience_duration_hours)
+    trial_slots.active[member.id] = end_time
+    member_index.update_member(member)
+    member_cache_policy.track(member.id)
+    audit_log.record('trial_grant', member.id, role.id, actor_id=actor_id,
+                     detail=f'体验 {format_duration_hours(CONFIG.experience_duration_hours)}')
+    schedule_expiry_notices('experience', member.id, role.id, start, end_time)
+    return end_time
+
+# 为等候队列中的用户开通体验并私信通知（调用方需先占用名额），返回是否已开通
+async def promote_waitlisted_user(user_id):
+    guild = bot.get_guild(CONFIG.guild_id)
+    role = guild.get_role(CONFIG.vip_role_id) if guild else None
+    if not role:
+        raise RuntimeError('找不到服务器或会员身份组')
+    user_info = await asyncio.to_thread(get_user_info, user_id)
+    if user_info and user_info[1] == 1:
+        return False
+    member = guild.get_member(user_id)
+    if member is None:
+        try:
+            member = await guild.fetch_member(user_id)
+        except discord.NotFound:
+            return False  # 用户已离开服务器
+    
+    end_time = await start_trial(member, role)
+    print(f'✅ 已为等候队列中的用户 {user_id} 开通体验')
+    # 先登记通知记录，发送状态才能写入数据库，重启后未发出的通知会重新发送
+    notice_key = ('waitlist', user_id, role.id, end_time.isoformat(), 'promoted')
+    if await asyncio.to_thread(claim_expiry_notice, *notice_key):
+        dm_queue.put(notice_key, user_id, build_promotion_notice(guild.name, end_time))
+    return True
+
+# 定时任务：释放已到期的体验名额
+@tasks.loop(seconds=30)
+async def release_expired_trial_slots():
+    trial_slots.expire(clock.now())
+
+# ========== 成员名字解析 ==========
+
+MEMBER_NAME_TTL = timedelta(hours=1)  # 名字缓存的有效期
+MEMBER_QUERY_BATCH = 100  # Gateway 成员查询每次最多 100 个用户ID
+
+# 解析列表中用户的显示名字：缓存中的成员直接读取，其余先查内存/数据库中未过期的名字缓存，
+# 仍然缺少的按页通过 Gateway 成员查询（query_members）批量获取，不逐个调用 fetch_member
+class NameResolver:
+    def __init__(self, ttl=MEMBER_NAME_TTL):
+        self.ttl = ttl
+        self._cache = {}  # 用户ID -> (显示名字, 是否在服务器中, 解析时间)
+
+    def _fresh(self, entry, now):
+        return entry is not None and now - entry[2] < self.ttl
+
+    # 返回 {用户ID: (显示名字或 None, 是否在服务器中)}
+    async def resolve(self, guild, user_ids):
+        now = clock.now()
+        result = {}
+        updated = []
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            member = guild.get_member(user_id) if guild else None
+            if member is not None:
+                result[user_id] = (member.display_name, True)
+                entry = self._cache.get(user_id)
+                if entry is None or entry[:2] != (member.display_name, True):
+                    self._cache[user_id] = (member.display_name, True, now)
+                    updated.append(user_id)
+            elif self._fresh(self._cache.get(user_id), now):
+                result[user_id] = self._cache[user_id][:2]
+            else:
+                missing.append(user_id)
+
+        if missing:
+            stored = await asyncio.to_thread(load_member_names, missing)
+            self._cache.update(stored)
+            missing = [user_id for user_id in missing if not self._fresh(stored.get(user_id), now)]
+
+        # 成员列表中已没有的用户直接标记为不在服务器中，不必查询
+        if guild and missing:
+            absent = [user_id for user_id in missing if member_cache_policy.known_absent(guild, user_id)]
+            for user_id in absent:
+                previous = self._cache.get(user_id)
+                self._cache[user_id] = (previous[0] if previous else None, False, now)
+                updated.append(user_id)
+            if absent:
+                absent = set(absent)
+                missing = [user_id for user_id in missing if user_id not in absent]
+
+        # 同一页缺少的用户合并成尽量少的查询
+        for i in range(0, len(missing) if guild else 0, MEMBER_QUERY_BATCH):
+            batch = missing[i:i + MEMBER_QUERY_BATCH]
+            try:
+                members = await guild.query_members(user_ids=batch, limit=len(batch), cache=False)
+            except asyncio.TimeoutError:
+                print(f'查询 {len(batch)} 个成员的名字超时，使用已缓存的名字')
+                continue
+            found = {member.id: member for member in members}
+            for user_id in batch:
+                if user_id in found:
+                    self._cache[user_id] = (found[user_id].display_name, True, now)
+                else:
+                    # 不在服务器中：保留之前记录的名字
+                    previous = self._cache.get(user_id)
+                    self._cache[user_id] = (previous[0] if previous else None, False, now)
+                updated.append(user_id)
+
+        for user_id in user_ids:
+            if user_id not in result and user_id in self._cache:
+                result[user_id] = self._cache[user_id][:2]
+        if updated:
+            await asyncio.to_thread(save_member_names, [(user_id,) + self._cache[user_id] for user_id in updated])
+        return result
+
+    # 列表中显示的用户名字
+    @staticmethod
+    def label(user_id, resolved):
+        name, in_guild = resolved.get(user_id, (None, None))
+        if in_guild:
+            return name
+        if in_guild is None:
+            return f'用户ID: {user_id}'
+        return f'{name} (已离开服务器)' if name else f'用户ID: {user_id} (不在服务器中)'
+
+name_resolver = NameResolver()
+
+# ========== 成员搜索索引 ==========
+
+# 有记录用户的前缀索引：有序的 (关键字, 用户ID) 列表 + 二分查找
+class MemberIndex:
+    def __init__(self):
+        self._keys = []
+        self._user_keys = {}
+        self._labels = {}
+
+    def __len__(self):
+        return len(self._labels)
+
+    def __contains__(self, user_id):
+        return user_id in self._labels
+
+    @staticmethod
+    def _tokens(user_id, names):
+        tokens = {str(user_id)}
+        for name in names:
+            if not name:
+                continue
+            name = name.lower()
+            tokens.add(name)
+            tokens.update(name.split())
+        return tokens
+
+    def update(self, user_id, *names):
+        self.remove(user_id)
+        names = [name for name in names if name]
+        keys = sorted(self._tokens(user_id, names))
+        for key in keys:
+            bisect.insort(self._keys, (key, user_id))
+        self._user_keys[user_id] = keys
+        self._labels[user_id] = f'{names[0]} ({user_id})' if names else str(user_id)
+
+    def update_member(self, member):
+        self.update(member.id, member.display_name, member.name)
+
+    def remove(self, user_id):
+        for key in self._user_keys.pop(user_id, ()):
+            i = bisect.bisect_left(self._keys, (key, user_id))
+            if i < len(self._keys) and self._keys[i] == (key, user_id):
+                del self._keys[i]
+        self._labels.pop(user_id, None)
+
+    def rebuild(self, entries):
+        # entries: [(user_id, [名字...])]，一次性排序比逐条插入快
+        self._keys = []
+        self._user_keys = {}
+        self._labels = {}
+        for user_id, names in entries:
+            names = [name for name in names if name]
+            keys = sorted(self._tokens(user_id, names))
+            self._keys.extend((key, user_id) for key in keys)
+            self._user_keys[user_id] = keys
+            self._labels[user_id] = f'{names[0]} ({user_id})' if names else str(user_id)
+        self._keys.sort()
+
+    def search(self, prefix, limit=25):
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return [(user_id, label) for user_id, label in itertools.islice(self._labels.items(), limit)]
+        results = []
+        seen = set()
+        i = bisect.bisect_left(self._keys, (prefix,))
+        while i < len(self._keys) and len(results) < limit:
+            key, user_id = self._keys[i]
+            if not key.startswith(prefix):
+                break
+            if user_id not in seen:
+                seen.add(user_id)
+                results.append((user_id, self._labels[user_id]))
+            i += 1
+        return results
+
+member_index = MemberIndex()
+
+# 根据数据库记录和成员缓存重建索引
+def rebuild_member_index(guild):
+    entries = []
+    user_ids = get_tracked_user_ids()
+    # 不在缓存中的成员使用之前解析过的名字
+    stored = load_member_names(user_id for user_id in user_ids if not (guild and guild.get_member(user_id)))
+    for user_id in user_ids:
+        member = guild.get_member(user_id) if guild else None
+        if member:
+            entries.append((user_id, [member.display_name, member.name]))
+        else:
+            entries.append((user_id, [stored[user_id][0]] if user_id in stored else []))
+    member_index.rebuild(entries)
+    print(f'成员搜索索引已建立：{len(member_index)} 个用户')
+
+# 解析用户输入的用户ID（支持纯数字和 <@ID> 提及）
+def parse_user_id(value):
+    match = re.fullmatch(r'\s*<?@?!?(\d{15,20})>?\s*', value or '')
+    return int(match.group(1)) if match else None
+
+# 斜杠命令自动补全：搜索有记录的用户
+async def tracked_user_autocomplete(interaction: discord.Interaction, current: str):
+    return [
+        app_commands.Choice(name=label[:100], value=str(user_id))
+        for user_id, label in member_index.search(current)
+    ]
+
+_background_tasks = {}
+
+# 启动常驻后台任务（重连触发 on_ready 时不会重复启动）
+def start_background_task(name, coro_factory):
+    task = _background_tasks.get(name)
+    if task is None or task.done():
+        _background_tasks[name] = asyncio.create_task(coro_factory())
+
+# 重新建立成员缓存（每次 on_ready 时 discord.py 都已清空了之前的成员缓存）
+async def prime_member_cache(guild):
+    member_cache_policy.reset()
+    try:
+        await member_cache_policy.prime(guild)
     except Exception as e:
-        print(f'检查过期权限时出错：{str(e)}')
+        print(f'建立成员缓存时出错：{str(e)}')
 
 @bot.event
 async def on_ready():
     print(f'{bot.user} 已上线！')
-    init_db()
-    check_expired_roles.start()
+    # 断线重连也会触发 on_ready，定时任务只启动一次
+    if not EXTERNAL_EXPIRY_WORKER and not check_expired_roles.is_running():
+        check_expired_roles.start()
+    if not reconcile_pending_members.is_running():
+        reconcile_pending_members.start()
+    if 'expiry_notices' not in _background_tasks:
+        load_expiry_notices()
+    start_background_task('expiry_notices', lambda: expiry_scheduler.run(send_expiry_notice))
+    start_background_task('dm_queue', lambda: dm_queue.run(bot))
+    start_background_task('audit_log', audit_log.run)
+    if not release_expired_trial_slots.is_running():
+        release_expired_trial_slots.start()
+    if BACKUP_INTERVAL_HOURS > 0 and not backup_database_task.is_running():
+        backup_database_task.start()
     print('定时任务已启动')
+
+    # 启动时做一次全量对账，之后只根据成员变化增量对账
+    guild = bot.get_guild(CONFIG.guild_id)
+    if guild:
+        await prime_member_cache(guild)
+    else:
+        member_cache_policy.reset()
+    if member_cache_policy.enabled and not prune_member_cache.is_running():
+        prune_member_cache.start()
+    rebuild_member_index(guild)
+    if guild:
+        try:
+            report, enqueued, stats = await reconcile_roles(guild)
+            print(f'[对账] 启动全量对账完成，发现 {enqueued} 处漂移，执行结果：{format_revocation_stats(stats)}')
+        except Exception as e:
+            print(f'启动对账时出错：{str(e)}')
     
     # 同步斜杠命令
     try:
         # 如果有配置 GUILD_ID，先同步到特定服务器（更快）
-        if GUILD_ID:
-            guild = discord.Object(id=GUILD_ID)
+        if CONFIG.guild_id:
+            guild = discord.Object(id=CONFIG.guild_id)
             bot.tree.copy_global_to(guild=guild)
             synced = await bot.tree.sync(guild=guild)
-            print(f'已同步 {len(synced)} 个斜杠命令到服务器 {GUILD_ID}')
+            print(f'已同步 {len(synced)} 个斜杠命令到服务器 {CONFIG.guild_id}')
             for cmd in synced:
                 print(f'  - /{cmd.name}: {cmd.description}')
         else:
@@ -585,10 +2855,20 @@ async def on_ready():
         import traceback
         traceback.print_exc()
 
-@bot.tree.command(name='setup', description='发送体验权限申请面板（仅管理员可用）')
-@app_commands.checks.has_permissions(administrator=True)
-async def setup_experience(interaction: discord.Interaction):
-    """发送体验权限申请消息（仅管理员可用）"""
+# 体验时长显示
+def format_duration_hours(hours):
+    if hours < 1:
+        return f'{int(hours * 60)}分钟'
+    return f'{hours:g}小时'
+
+_setup_embed_cache = None
+
+# 体验申请面板（缓存，配置变更时失效）
+def build_setup_embed():
+    global _setup_embed_cache
+    if _setup_embed_cache is not None:
+        return _setup_embed_cache
+    
     embed = discord.Embed(
         title='✨ 体验权限申请 ✨',
         description='点击下方按钮申请体验权限。',
@@ -606,19 +2886,25 @@ async def setup_experience(interaction: discord.Interaction):
         inline=False
     )
     
-    # 计算体验时长显示
-    if EXPERIENCE_DURATION_HOURS < 1:
-        duration_minutes = int(EXPERIENCE_DURATION_HOURS * 60)
-        duration_display = f'{duration_minutes}分钟'
-    else:
-        duration_display = f'{EXPERIENCE_DURATION_HOURS}小时'
-    
     embed.add_field(
         name='⏰ 体验时长',
-        value=duration_display,
+        value=format_duration_hours(CONFIG.experience_duration_hours),
         inline=False
     )
     
+    _setup_embed_cache = embed
+    return embed
+
+def invalidate_setup_embed():
+    global _setup_embed_cache
+    _setup_embed_cache = None
+
+@bot.tree.command(name='setup', description='发送体验权限申请面板（仅管理员可用）')
+@app_commands.checks.has_permissions(administrator=True)
+async def setup_experience(interaction: discord.Interaction):
+    """发送体验权限申请消息（仅管理员可用）"""
+    embed = build_setup_embed()
+    
     view = ExperienceView()
     try:
         await interaction.response.send_message(embed=embed, view=view)
@@ -636,7 +2922,7 @@ async def check_all_users(interaction: discord.Interaction):
     """查看所有体验用户信息（仅管理员可用）"""
     await interaction.response.defer(ephemeral=True)
     
-    conn = sqlite3.connect('vip_experience.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT user_id, start_time, used FROM user_experience WHERE used = 1')
     users = c.fetchall()
@@ -652,11 +2938,12 @@ async def check_all_users(interaction: discord.Interaction):
     items_per_page = 20
     total_pages = (len(users) + items_per_page - 1) // items_per_page
     
-    # 生成所有页面
-    pages = []
-    for page_num in range(total_pages):
+    # 按需生成页面：翻到某页时才批量解析该页用户的名字
+    async def build_page(page_num):
         start_idx = page_num * items_per_page
         end_idx = min(start_idx + items_per_page, len(users))
+        page_users = users[start_idx:end_idx]
+        names = await name_resolver.resolve(guild, [user_id for user_id, _, _ in page_users])
         
         embed = discord.Embed(
             title='📋 体验用户列表',
@@ -664,12 +2951,8 @@ async def check_all_users(interaction: discord.Interaction):
             color=discord.Color.blue()
         )
         
-        for user_id, start_time_str, used in users[start_idx:end_idx]:
-            member = guild.get_member(user_id)
-            if member:
-                username = member.display_name
-            else:
-                username = f'用户ID: {user_id} (不在服务器或不在缓存中)'
+        for user_id, start_time_str, used in page_users:
+            username = NameResolver.label(user_id, names)
             
             if start_time_str:
                 remaining = get_remaining_time(start_time_str)
@@ -690,14 +2973,14 @@ async def check_all_users(interaction: discord.Interaction):
             )
         
         embed.set_footer(text=f'第 {page_num + 1} 页，共 {total_pages} 页')
-        pages.append(embed)
+        return embed
     
     # 发送第一页
+    view = await PaginatedView.create(total_pages, build_page)
     if total_pages > 1:
-        view = PaginatedView(pages, initial_page=0)
-        await interaction.followup.send(embed=pages[0], view=view, ephemeral=True)
+        await interaction.followup.send(embed=view.pages[0], view=view, ephemeral=True)
     else:
-        await interaction.followup.send(embed=pages[0], ephemeral=True)
+        await interaction.followup.send(embed=view.pages[0], ephemeral=True)
 
 @bot.tree.command(name='checkexpired', description='立即检查并移除所有过期的体验权限（仅管理员可用）')
 @app_commands.checks.has_permissions(administrator=True)
@@ -710,93 +2993,209 @@ async def check_expired_now(interaction: discord.Interaction):
         await interaction.followup.send('❌ 无法获取服务器信息', ephemeral=True)
         return
     
-    role = guild.get_role(VIP_ROLE_ID)
+    role = guild.get_role(CONFIG.vip_role_id)
     if not role:
         await interaction.followup.send('❌ 找不到会员身份组，请检查配置！', ephemeral=True)
         return
     
-    conn = sqlite3.connect('vip_experience.db')
-    c = conn.cursor()
-    c.execute('SELECT user_id, start_time FROM user_experience WHERE used = 1')
-    users = c.fetchall()
-    conn.close()
-    
-    removed_count = 0
-    expired_count = 0
-    checked_count = 0
-    already_removed_count = 0
-    
-    for user_id, start_time_str in users:
-        if not start_time_str:
-            continue
-        
-        checked_count += 1
-        remaining = get_remaining_time(start_time_str)
-        if remaining is None:  # 已过期
-            expired_count += 1
-            member = guild.get_member(user_id)
-            
-            # 检查是否是服务器所有者
-            is_owner = guild.owner_id == user_id if guild.owner_id else False
-            
-            if member:
-                if role in member.roles:
-                    # 用户有身份组，需要移除
-                    if is_owner:
-                        # 服务器所有者无法移除身份组（Discord限制）
-                        print(f'⚠️ 用户 {member.name} ({user_id}) 是服务器所有者，无法自动移除身份组（Discord限制）')
-                        # 标记为已处理（虽然实际上无法移除）
-                        already_removed_count += 1
-                    else:
-                        # 直接尝试移除
-                        try:
-                            await member.remove_roles(role)
-                            removed_count += 1
-                            print(f'✅ [checkexpired] 已移除用户 {member.name} ({user_id}) 的体验权限')
-                        except discord.Forbidden:
-                            print(f'❌ [checkexpired] 权限不足：无法移除用户 {member.name} ({user_id}) 的身份组')
-                            print(f'   提示：确保机器人的身份组在服务器身份组列表中位于会员身份组之上')
-                        except Exception as e:
-                            print(f'❌ [checkexpired] 移除用户 {member.name} ({user_id}) 权限时出错：{str(e)}')
-                else:
-                    # 用户没有身份组，可能已经被移除了
-                    already_removed_count += 1
-                    print(f'用户 {member.name} ({user_id}) 的身份组已被移除')
-            elif is_owner:
-                # 服务器所有者可能不在缓存中，但我们可以检测到
-                print(f'⚠️ 用户 {user_id} 是服务器所有者，无法自动移除身份组（Discord限制）')
-                already_removed_count += 1
-            else:
-                # 用户不在服务器中或不在缓存中
-                print(f'⚠️ 用户 {user_id} 不在服务器缓存中，但记录显示已过期')
-                print(f'   提示：用户可能已离开服务器，或者需要启用 members intent 才能检测')
+    # 与定时任务走同一条撤销路径
+    enqueued, stats = await run_expiry_sweep(GatewayRevoker(guild))
+    processed_count = sum(stats.values())
+    removed_count = stats.get('removed', 0)
+    already_removed_count = stats.get('absent', 0) + stats.get('left', 0) + stats.get('role_missing', 0)
+    superseded_count = stats.get('superseded', 0)
+    failed_count = stats.get('error', 0)
     
     # 构建报告消息
-    report_parts = [f'✅ 检查完成！', f'📊 检查了 {checked_count} 个用户']
+    report_parts = ['✅ 检查完成！', f'📥 新增 {enqueued} 个撤销任务', f'📊 执行了 {processed_count} 个待撤销任务']
     
-    if expired_count > 0:
-        report_parts.append(f'⏰ 发现 {expired_count} 个过期用户')
+    if processed_count > 0:
         if removed_count > 0:
             report_parts.append(f'🗑️ 移除了 {removed_count} 个过期权限')
         if already_removed_count > 0:
-            report_parts.append(f'✅ {already_removed_count} 个用户的权限已被移除（可能之前已处理）')
+            report_parts.append(f'✅ {already_removed_count} 个用户的权限已被移除或已离开服务器')
+        if superseded_count > 0:
+            report_parts.append(f'🔄 {superseded_count} 个任务因续期或重新申请而取消')
         
-        # 如果有过期用户但没有成功移除，说明有问题
-        failed_count = expired_count - removed_count - already_removed_count
+        # 有任务失败，说明有问题（失败的任务会在下次检查时重试）
         if failed_count > 0:
             report_parts.append(f'')
             report_parts.append(f'⚠️ **警告**：有 {failed_count} 个过期用户的权限未能移除！')
             report_parts.append(f'可能的原因：')
             report_parts.append(f'1. 机器人的身份组位置低于会员身份组')
             report_parts.append(f'2. 机器人没有"管理身份组"权限')
-            report_parts.append(f'3. 用户不在服务器缓存中')
             report_parts.append(f'')
-            report_parts.append(f'💡 可以使用 `/removeuser <用户ID>` 命令删除该用户的记录')
+            report_parts.append(f'失败的任务会自动重试，最多 {REVOCATION_MAX_ATTEMPTS} 次')
+            report_parts.append('💡 可以使用 `/reconcile` 对比数据库记录与实际身份组，或使用 `/removeuser <用户ID>` 命令删除该用户的记录')
     else:
         report_parts.append(f'✨ 没有发现过期权限')
     
     await interaction.followup.send('\n'.join(report_parts), ephemeral=True)
 
+@bot.tree.command(name='reconcile', description='对比数据库记录与实际身份组并修复差异（仅管理员可用）')
+@app_commands.checks.has_permissions(administrator=True)
+async def reconcile_cmd(interaction: discord.Interaction):
+    """对比数据库记录与实际身份组并修复差异（仅管理员可用）"""
+    await interaction.response.defer(ephemeral=True)
+    
+    guild = interaction.guild
+    if not guild:
+        await interaction.followup.send('❌ 无法获取服务器信息', ephemeral=True)
+        return
+    
+    report, enqueued, stats = await reconcile_roles(guild)
+    if not report:
+        await interaction.followup.send('📋 当前没有需要对账的身份组', ephemeral=True)
+        return
+    
+    embed = discord.Embed(
+        title='🔍 身份组对账结果',
+        description=f'发现 {enqueued} 处漂移，执行结果：{format_revocation_stats(stats)}',
+        color=discord.Color.blue()
+    )
+    for role_id, counts in report.items():
+        role = guild.get_role(role_id)
+        embed.add_field(
+            name=role.name if role else f'ID: {role_id}',
+            value=(
+                f'持有人数: {counts["holders"]}\n'
+                f'已失效仍持有（已撤销）: {counts["drift"]}\n'
+                f'有效但未持有: {counts["missing"]}\n'
+                f'无有效记录（未处理）: {counts["untracked"]}'
+            ),
+            inline=False
+        )
+    
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+@bot.tree.command(name='export', description='导出体验/身份组记录和统计数据（仅管理员可用）')
+@app_commands.checks.has_permissions(administrator=True)
+@app_commands.describe(table='要导出的数据表', fmt='导出格式')
+@app_commands.rename(fmt='format')
+@app_commands.choices(
+    table=[app_commands.Choice(name=name, value=name) for name in EXPORT_TABLES],
+    fmt=[app_commands.Choice(name=name, value=name) for name in EXPORT_FORMATS],
+)
+async def export_cmd(interaction: discord.Interaction, table: str, fmt: str = 'csv'):
+    """导出体验/身份组记录和统计数据（仅管理员可用）"""
+    await interaction.response.defer(ephemeral=True)
+    
+    try:
+        # 导出在线程中进行，避免阻塞事件循环
+        out_path, row_count = await asyncio.to_thread(export_table, table, fmt)
+    except Exception as e:
+        await interaction.followup.send(f'❌ 导出失败：{str(e)}', ephemeral=True)
+        return
+    
+    # Discord 附件大小有限，过大的文件只返回服务器上的路径
+    if os.path.getsize(out_path) > 24 * 1024 * 1024:
+        await interaction.followup.send(
+            f'✅ 已导出 {row_count} 行，文件过大无法上传\n📁 服务器路径：`{out_path}`',
+            ephemeral=True
+        )
+        return
+    
+    await interaction.followup.send(
+        f'✅ 已导出 `{table}` 共 {row_count} 行',
+        file=discord.File(out_path),
+        ephemeral=True
+    )
+
+@bot.tree.command(name='profile', description='采样分析机器人的CPU和内存分配（仅管理员可用）')
+@app_commands.checks.has_permissions(administrator=True)
+@app_commands.describe(seconds='采样时长（秒）')
+async def profile_cmd(interaction: discord.Interaction, seconds: app_commands.Range[int, 1, PROFILE_MAX_SECONDS] = 30):
+    """采样分析机器人的CPU和内存分配（仅管理员可用）"""
+    await interaction.response.defer(ephemeral=True)
+    
+    try:
+        profiler, top_allocations, paths = await capture_profile(seconds)
+    except RuntimeError as e:
+        await interaction.followup.send(f'❌ {str(e)}', ephemeral=True)
+        return
+    
+    report_parts = [
+        '✅ 性能分析完成！',
+        f'📊 {seconds} 秒内采样 {profiler.samples} 次，共 {len(profiler.stacks)} 个不同调用栈',
+    ]
+    if top_allocations:
+        report_parts.append('💾 内存分配最多的位置：')
+        for stat in top_allocations[:5]:
+            frame = stat.traceback[0]
+            report_parts.append(f'`{os.path.basename(frame.filename)}:{frame.lineno}` {stat.size / 1024:.1f} KiB')
+    report_parts.append(f'📁 服务器路径：`{PROFILE_DIR}/`')
+    
+    files = [discord.File(path) for path in paths if os.path.getsize(path) <= 24 * 1024 * 1024]
+    await interaction.followup.send('\n'.join(report_parts), files=files, ephemeral=True)
+
+@bot.tree.command(name='backup', description='立即备份数据库（仅管理员可用）')
+@app_commands.checks.has_permissions(administrator=True)
+async def backup_cmd(interaction: discord.Interaction):
+    """立即备份数据库（仅管理员可用）"""
+    await interaction.response.defer(ephemeral=True)
+    
+    try:
+        path, size, elapsed, max_lag = await run_backup()
+    except Exception as e:
+        await interaction.followup.send(f'❌ 备份失败：{str(e)}', ephemeral=True)
+        return
+    
+    await interaction.followup.send(
+        f'✅ 备份完成！\n'
+        f'📁 服务器路径：`{path}`（{size / 1024 / 1024:.1f} MB）\n'
+        f'⏱️ 耗时 {elapsed:.2f} 秒，期间事件循环最大延迟 {max_lag * 1000:.0f} 毫秒\n'
+        f'🗂️ 保留最近 {BACKUP_KEEP} 个快照',
+        ephemeral=True
+    )
+
+# ========== 配置管理命令 ==========
+
+@bot.tree.command(name='config', description='查看运行时配置（仅管理员可用）')
+@app_commands.checks.has_permissions(administrator=True)
+async def show_config_cmd(interaction: discord.Interaction):
+    """查看运行时配置"""
+    stored = get_stored_config_keys()
+    embed = discord.Embed(title='⚙️ 运行时配置', color=discord.Color.blue())
+    for key, (_, description) in CONFIG_FIELDS.items():
+        source = '数据库' if key in stored else '环境变量/默认值'
+        embed.add_field(
+            name=f'{description} ({key})',
+            value=f'{getattr(CONFIG, key)}（来源：{source}）',
+            inline=False
+        )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name='setconfig', description='修改运行时配置，立即生效（仅管理员可用）')
+@app_commands.checks.has_permissions(administrator=True)
+@app_commands.describe(key='配置项', value='新的值')
+@app_commands.choices(key=[
+    app_commands.Choice(name=f'{description} ({key})', value=key)
+    for key, (_, description) in CONFIG_FIELDS.items()
+])
+async def set_config_cmd(interaction: discord.Interaction, key: str, value: str):
+    """修改运行时配置"""
+    try:
+        old, new = update_config(key, value)
+    except ValueError as e:
+        await interaction.response.send_message(f'❌ {str(e)}', ephemeral=True)
+        return
+    
+    audit_log.record('config_change', actor_id=interaction.user.id,
+                     detail=f'{key}: {getattr(old, key)} → {getattr(new, key)}')
+    await interaction.response.send_message(
+        f'✅ 已更新配置 `{key}`：{getattr(old, key)} → {getattr(new, key)}',
+        ephemeral=True
+    )
+    
+    # 切换服务器后把斜杠命令同步到新服务器
+    if key == 'guild_id' and old.guild_id != new.guild_id:
+        try:
+            guild = discord.Object(id=new.guild_id)
+            bot.tree.copy_global_to(guild=guild)
+            await bot.tree.sync(guild=guild)
+        except Exception as e:
+            print(f'同步斜杠命令到服务器 {new.guild_id} 时出错：{e}')
+
 # ========== 身份组管理命令 ==========
 
 @bot.tree.command(name='addrole', description='添加身份组配置（仅管理员可用）')
@@ -808,13 +3207,16 @@ async def add_role_config_cmd(interaction: discord.Interaction, role: discord.Ro
         await interaction.response.send_message('❌ 天数必须大于0！', ephemeral=True)
         return
     
-    add_role_config(role.id, role.name, days)
-    await interaction.response.send_message(
-        f'✅ 已添加身份组配置：\n'
-        f'身份组：{role.mention} ({role.name})\n'
-        f'有效期：{days} 天',
-        ephemeral=True
-    )
+    async def work():
+        await asyncio.to_thread(add_role_config, role.id, role.name, days)
+        audit_log.record('role_config_add', role_id=role.id, actor_id=interaction.user.id, detail=f'{role.name}，{days} 天')
+        return (
+            f'✅ 已添加身份组配置：\n'
+            f'身份组：{role.mention} ({role.name})\n'
+            f'有效期：{days} 天'
+        )
+    
+    await interaction_pool.submit(interaction, work)
 
 @bot.tree.command(name='listroles', description='查看所有身份组配置（仅管理员可用）')
 @app_commands.checks.has_permissions(administrator=True)
@@ -855,6 +3257,8 @@ async def remove_role_config_cmd(interaction: discord.Interaction, role: discord
         return
     
     delete_role_config(role.id)
+    audit_log.record('role_config_remove', role_id=role.id, actor_id=interaction.user.id,
+                     detail=f'{config[1]}，{config[2]} 天')
     await interaction.response.send_message(
         f'✅ 已删除身份组配置：{role.mention}',
         ephemeral=True
@@ -865,100 +3269,173 @@ async def remove_role_config_cmd(interaction: discord.Interaction, role: discord
 @app_commands.describe(member='要赋予身份组的用户', role='要赋予的身份组', days='有效期天数（可选，默认使用配置）')
 async def give_member_role_cmd(interaction: discord.Interaction, member: discord.Member, role: discord.Role, days: int = None):
     """赋予用户身份组"""
-    # 检查身份组是否已配置
-    config = get_role_config(role.id)
-    if not config and days is None:
-        await interaction.response.send_message(
-            f'❌ 身份组 {role.mention} 未配置！\n'
-            f'请先使用 `/addrole` 配置身份组，或在此命令中指定天数。',
-            ephemeral=True
-        )
+    if days is not None and days <= 0:
+        await interaction.response.send_message('❌ 天数必须大于0！', ephemeral=True)
         return
     
-    # 确定天数
-    if days is None:
-        duration_days = config[2]  # 使用配置的天数
-    else:
-        if days <= 0:
-            await interaction.response.send_message('❌ 天数必须大于0！', ephemeral=True)
-            return
-        duration_days = days
-    
-    try:
-        # 赋予身份组
-        await member.add_roles(role)
+    async def work():
+        # 检查身份组是否已配置
+        config = await asyncio.to_thread(get_role_config, role.id)
+        if not config and days is None:
+            return (
+                f'❌ 身份组 {role.mention} 未配置！\n'
+                f'请先使用 `/addrole` 配置身份组，或在此命令中指定天数。'
+            )
         
-        # 记录到数据库
-        end_time = add_user_role(member.id, role.id, duration_days)
+        # 确定天数
+        duration_days = config[2] if days is None else days  # 未指定时使用配置的天数
         
-        await interaction.response.send_message(
+        try:
+            # 赋予身份组
+            await member.add_roles(role)
+        except discord.Forbidden:
+            return '❌ 错误：机器人没有权限赋予身份组！'
+        
+        # 记录到数据库：已有未到期的同一身份组时合并为一条记录
+        granted_at = clock.now()
+        start_time, end_time = await asyncio.to_thread(add_user_role, member.id, role.id, duration_days)
+        await asyncio.to_thread(record_role_granted, member.id, role.id, granted_at.isoformat())
+        schedule_expiry_notices('user_role', member.id, role.id, start_time, end_time)
+        member_index.update_member(member)
+        member_cache_policy.track(member.id)
+        audit_log.record('role_grant', member.id, role.id, actor_id=interaction.user.id,
+                         detail=f'{duration_days} 天，到期时间 {end_time.isoformat()}')
+        
+        message = (
             f'✅ 已赋予用户 {member.mention} 身份组 {role.mention}\n'
             f'⏰ 有效期：{duration_days} 天\n'
-            f'📅 到期时间：{end_time.strftime("%Y-%m-%d %H:%M:%S")}',
-            ephemeral=True
-        )
-    except discord.Forbidden:
-        await interaction.response.send_message(
-            '❌ 错误：机器人没有权限赋予身份组！',
-            ephemeral=True
-        )
-    except Exception as e:
-        await interaction.response.send_message(
-            f'❌ 发生错误：{str(e)}',
-            ephemeral=True
+            f'📅 到期时间：{end_time.strftime("%Y-%m-%d %H:%M:%S")}'
         )
+        if start_time < granted_at:
+            message += f'\nℹ️ 用户已持有该身份组（自 {start_time.strftime("%Y-%m-%d %H:%M:%S")} 起），已合并为一条记录，到期时间取较晚者'
+        return message
+    
+    await interaction_pool.submit(interaction, work)
 
 @bot.tree.command(name='checkmember', description='查看用户的所有身份组记录（仅管理员可用）')
 @app_commands.checks.has_permissions(administrator=True)
-@app_commands.describe(member='要查看的用户')
-async def check_member_roles_cmd(interaction: discord.Interaction, member: discord.Member):
+@app_commands.describe(member='要查看的用户（输入名字或ID搜索）')
+@app_commands.autocomplete(member=tracked_user_autocomplete)
+async def check_member_roles_cmd(interaction: discord.Interaction, member: str):
     """查看用户的所有身份组记录"""
-    records = get_user_roles(member.id)
+    user_id = parse_user_id(member)
+    if user_id is None:
+        await interaction.response.send_message('❌ 无效的用户ID！', ephemeral=True)
+        return
     
-    if not records:
-        await interaction.response.send_message(
-            f'📋 用户 {member.mention} 没有身份组记录',
-            ephemeral=True
+    async def work():
+        records = await asyncio.to_thread(get_user_roles, user_id)
+        
+        if not records:
+            return f'📋 用户 <@{user_id}> 没有身份组记录'
+        
+        names = await name_resolver.resolve(interaction.guild, [user_id])
+        display_name = NameResolver.label(user_id, names)
+        embed = discord.Embed(
+            title=f'📋 {display_name} 的身份组记录',
+            color=discord.Color.blue()
         )
+        
+        for record in records:
+            record_id, role_id, start_time_str, end_time_str, duration_days, role_name = record
+            start_time = datetime.fromisoformat(start_time_str)
+            end_time = datetime.fromisoformat(end_time_str)
+            now = clock.now()
+            
+            role = interaction.guild.get_role(role_id)
+            if role:
+                role_display = role.mention
+            else:
+                role_display = f'身份组已删除 (ID: {role_id})'
+            
+            if now >= end_time:
+                status = '⏰ 已过期'
+            else:
+                remaining = end_time - now
+                days = remaining.days
+                hours = remaining.seconds // 3600
+                status = f'⏳ 剩余 {days}天{hours}小时'
+            
+            embed.add_field(
+                name=f'{role_name or f"ID: {role_id}"} (记录ID: {record_id})',
+                value=(
+                    f'身份组: {role_display}\n'
+                    f'开始: {start_time.strftime("%Y-%m-%d %H:%M:%S")}\n'
+                    f'到期: {end_time.strftime("%Y-%m-%d %H:%M:%S")}\n'
+                    f'状态: {status}'
+                ),
+                inline=False
+            )
+        
+        return {'embed': embed}
+    
+    await interaction_pool.submit(interaction, work)
+
+@bot.tree.command(name='removeuser', description='删除用户的体验记录（仅管理员可用）')
+@app_commands.checks.has_permissions(administrator=True)
+@app_commands.describe(user_id='要删除记录的用户（输入名字或ID搜索）')
+@app_commands.autocomplete(user_id=tracked_user_autocomplete)
+async def remove_user_cmd(interaction: discord.Interaction, user_id: str):
+    """删除用户的体验记录"""
+    target_id = parse_user_id(user_id)
+    if target_id is None:
+        await interaction.response.send_message('❌ 无效的用户ID！', ephemeral=True)
         return
     
-    embed = discord.Embed(
-        title=f'📋 {member.display_name} 的身份组记录',
-        color=discord.Color.blue()
+    if not get_user_info(target_id):
+        await interaction.response.send_message(f'❌ 用户 <@{target_id}> 没有体验记录', ephemeral=True)
+        return
+    
+    delete_user_info(target_id)
+    trial_slots.release(target_id)
+    audit_log.record('user_remove', target_id, actor_id=interaction.user.id, detail='删除体验记录')
+    if not has_user_records(target_id):
+        member_index.remove(target_id)
+    await interaction.response.send_message(
+        f'✅ 已删除用户 <@{target_id}> 的体验记录',
+        ephemeral=True
     )
+
+@bot.tree.command(name='audit', description='查看用户的审计记录（仅管理员可用）')
+@app_commands.checks.has_permissions(administrator=True)
+@app_commands.describe(member='要查看的用户（输入名字或ID搜索）')
+@app_commands.autocomplete(member=tracked_user_autocomplete)
+async def audit_cmd(interaction: discord.Interaction, member: str):
+    """查看用户的审计记录"""
+    user_id = parse_user_id(member)
+    if user_id is None:
+        await interaction.response.send_message('❌ 无效的用户ID！', ephemeral=True)
+        return
     
-    for record in records:
-        record_id, role_id, start_time_str, end_time_str, duration_days, role_name = record
-        start_time = datetime.fromisoformat(start_time_str)
-        end_time = datetime.fromisoformat(end_time_str)
-        now = datetime.now()
-        
-        role = interaction.guild.get_role(role_id)
-        if role:
-            role_display = role.mention
-        else:
-            role_display = f'身份组已删除 (ID: {role_id})'
-        
-        if now >= end_time:
-            status = '⏰ 已过期'
-        else:
-            remaining = end_time - now
-            days = remaining.days
-            hours = remaining.seconds // 3600
-            status = f'⏳ 剩余 {days}天{hours}小时'
+    async def work():
+        # 先写入缓冲区中的事件，保证能查到刚刚发生的操作
+        await audit_log.flush()
+        events = await asyncio.to_thread(get_user_audit_events, user_id)
+        if not events:
+            return f'📋 用户 <@{user_id}> 没有审计记录'
         
-        embed.add_field(
-            name=f'{role_name or f"ID: {role_id}"} (记录ID: {record_id})',
-            value=(
-                f'身份组: {role_display}\n'
-                f'开始: {start_time.strftime("%Y-%m-%d %H:%M:%S")}\n'
-                f'到期: {end_time.strftime("%Y-%m-%d %H:%M:%S")}\n'
-                f'状态: {status}'
-            ),
-            inline=False
+        embed = discord.Embed(
+            title='📜 审计记录',
+            description=f'用户：<@{user_id}>（最近 {len(events)} 条）',
+            color=discord.Color.blue()
         )
+        for created_at, action, target_id, role_id, actor_id, detail in events:
+            lines = []
+            if target_id:
+                lines.append(f'用户: <@{target_id}>')
+            if role_id:
+                lines.append(f'身份组: <@&{role_id}>')
+            lines.append(f'操作人: <@{actor_id}>' if actor_id else '操作人: 系统')
+            if detail:
+                lines.append(f'详情: {detail}')
+            embed.add_field(
+                name=f'{AUDIT_ACTION_LABELS.get(action, action)} · {datetime.fromisoformat(created_at).strftime("%Y-%m-%d %H:%M:%S")}',
+                value='\n'.join(lines),
+                inline=False
+            )
+        return {'embed': embed}
     
-    await interaction.response.send_message(embed=embed, ephemeral=True)
+    await interaction_pool.submit(interaction, work)
 
 @bot.tree.command(name='listmembers', description='查看所有有身份组记录的用户（仅管理员可用）')
 @app_commands.checks.has_permissions(administrator=True)
@@ -990,11 +3467,12 @@ async def list_members_with_roles_cmd(interaction: discord.Interaction):
     items_per_page = 10
     total_pages = (len(user_list) + items_per_page - 1) // items_per_page
     
-    # 生成所有页面
-    pages = []
-    for page_num in range(total_pages):
+    # 按需生成页面：翻到某页时才批量解析该页用户的名字
+    async def build_page(page_num):
         start_idx = page_num * items_per_page
         end_idx = min(start_idx + items_per_page, len(user_list))
+        page_users = user_list[start_idx:end_idx]
+        names = await name_resolver.resolve(guild, [user_id for user_id, _ in page_users])
         
         embed = discord.Embed(
             title='📋 活跃身份组记录',
@@ -1002,18 +3480,14 @@ async def list_members_with_roles_cmd(interaction: discord.Interaction):
             color=discord.Color.blue()
         )
         
-        for user_id, records in user_list[start_idx:end_idx]:
-            member = guild.get_member(user_id)
-            if member:
-                username = member.display_name
-            else:
-                username = f'用户ID: {user_id}'
+        for user_id, records in page_users:
+            username = NameResolver.label(user_id, names)
             
             roles_info = []
             for record in records:
                 record_id, _, role_id, _, end_time_str, _, role_name = record
                 end_time = datetime.fromisoformat(end_time_str)
-                remaining = end_time - datetime.now()
+                remaining = end_time - clock.now()
                 days = remaining.days
                 hours = remaining.seconds // 3600
                 
@@ -1021,7 +3495,7 @@ async def list_members_with_roles_cmd(interaction: discord.Interaction):
                 if role:
                     role_display = role.name
                 else:
-                    role_display = f'ID: {role_id}'
+                    role_display = role_name or f'ID: {role_id}'
                 
                 roles_info.append(f'{role_display}: 剩余{days}天{hours}小时')
             
@@ -1032,21 +3506,421 @@ async def list_members_with_roles_cmd(interaction: discord.Interaction):
             )
         
         embed.set_footer(text=f'第 {page_num + 1} 页，共 {total_pages} 页')
-        pages.append(embed)
+        return embed
     
     # 发送第一页
+    view = await PaginatedView.create(total_pages, build_page)
     if total_pages > 1:
-        view = PaginatedView(pages, initial_page=0)
-        await interaction.followup.send(embed=pages[0], view=view, ephemeral=True)
+        await interaction.followup.send(embed=view.pages[0], view=view, ephemeral=True)
+    else:
+        await interaction.followup.send(embed=view.pages[0], ephemeral=True)
+
+# ========== 基准测试 ==========
+
+# 压测用的模拟交互：只记录第一次应答距离交互创建的时间
+class _BenchInteraction:
+    class _Response:
+        def __init__(self, interaction, rtt):
+            self._interaction = interaction
+            self._rtt = rtt
+            self._done = False
+
+        def is_done(self):
+            return self._done
+
+        async def _respond(self):
+            await asyncio.sleep(self._rtt)
+            if not self._done:
+                self._done = True
+                self._interaction.ack_latency = InteractionPool.age(self._interaction)
+
+        async def defer(self, **kwargs):
+            await self._respond()
+
+        async def send_message(self, *args, **kwargs):
+            await self._respond()
+
+    class _Followup:
+        def __init__(self, interaction, rtt):
+            self._interaction = interaction
+            self._rtt = rtt
+
+        async def send(self, *args, **kwargs):
+            await asyncio.sleep(self._rtt)
+            self._interaction.completed_latency = InteractionPool.age(self._interaction)
+
+    def __init__(self, rtt):
+        self.created_at = discord.utils.utcnow()
+        self.ack_latency = None
+        self.completed_latency = None
+        self.response = self._Response(self, rtt)
+        self.followup = self._Followup(self, rtt)
+
+# 压测：对比处理完再应答与快速应答两种模式下的交互过期率
+async def bench_interactions(mode, count, rate, rest_latency, disk_latency, rtt, seed):
+    rng = random.Random(seed)
+    pool = InteractionPool()
+    interactions = []
+    handlers = []
+
+    async def inline_handler(interaction, rest, disk):
+        # 原有方式：先调用接口、写数据库（阻塞事件循环），再应答
+        await asyncio.sleep(rest)
+        time.sleep(disk)
+        await interaction.response.send_message('ok')
+
+    async def fast_handler(interaction, rest, disk):
+        async def work():
+            await asyncio.sleep(rest)
+            await asyncio.to_thread(time.sleep, disk)
+            return 'ok'
+        await pool.submit(interaction, work)
+
+    handler = inline_handler if mode == 'inline' else fast_handler
+    for _ in range(count):
+        await asyncio.sleep(rng.expovariate(rate))
+        interaction = _BenchInteraction(rtt)
+        interactions.append(interaction)
+        # 延迟按对数正态分布注入，模拟偶发的慢请求
+        rest = rng.lognormvariate(0, 0.75) * rest_latency
+        disk = rng.lognormvariate(0, 0.75) * disk_latency
+        handlers.append(asyncio.create_task(handler(interaction, rest, disk)))
+
+    await asyncio.gather(*handlers)
+    await pool.drain()
+
+    ack = sorted(i.ack_latency for i in interactions)
+    expired = sum(1 for latency in ack if latency > INTERACTION_ACK_DEADLINE)
+    done = [i.completed_latency or i.ack_latency for i in interactions]
+    return {
+        'mode': mode,
+        'expired_rate': expired / count,
+        'ack_p50': statistics.median(ack),
+        'ack_p99': ack[min(len(ack) - 1, int(len(ack) * 0.99))],
+        'done_p50': statistics.median(done),
+    }
+
+# 压测：在模拟的大服务器上对比全量缓存与选择性缓存的内存占用
+def bench_member_cache(policy, count, tracked, state):
+    role_payload = lambda role_id, name: {
+        'id': str(role_id), 'name': name, 'color': 0, 'hoist': False, 'position': role_id,
+        'permissions': '0', 'managed': False, 'mentionable': False,
+    }
+    guild = discord.Guild(data={
+        'id': '1', 'name': 'bench', 'member_count': count, 'emojis': [], 'channels': [],
+        'roles': [role_payload(1, '@everyone'), role_payload(2, '会员'), role_payload(3, '普通')],
+    }, state=state)
+    cache = SelectiveMemberCache()
+    cache.tracked_roles = {2}
+    others = array('Q')
+
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    for i in range(count):
+        # 前 tracked 个成员持有会员身份组，其余只有普通身份组
+        member = discord.Member(data={
+            'user': {'id': str(10**17 + i), 'username': f'user{i}', 'discriminator': '0',
+                     'avatar': None, 'global_name': f'User {i}'},
+            'roles': ['2' if i < tracked else '3'],
+            'joined_at': '2024-01-01T00:00:00+00:00', 'nick': None, 'deaf': False, 'mute': False, 'flags': 0,
+        }, guild=guild, state=state)
+        if policy == 'full' or cache.should_cache(member):
+            guild._add_member(member)
+        else:
+            others.append(member.id)
+    cache._others = array('Q', sorted(others))
+    elapsed = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = {'policy': policy, 'cached': len(guild.members), 'ids': len(cache._others),
+              'current': current, 'peak': peak, 'elapsed': elapsed}
+    del guild, cache, others
+    gc.collect()
+    return result
+
+def run_bench_member_cache(args):
+    print(f'模拟服务器：{args.members} 个成员，其中 {args.tracked} 个持有会员身份组')
+    for policy in ('full', 'selective'):
+        result = bench_member_cache(policy, args.members, args.tracked, bot._connection)
+        print(f'{result["policy"]:>9}: 完整缓存 {result["cached"]} 人，仅记录ID {result["ids"]} 人，'
+              f'常驻内存 {result["current"] / 1024 / 1024:.1f} MB，峰值 {result["peak"] / 1024 / 1024:.1f} MB，'
+              f'耗时 {result["elapsed"]:.1f}s')
+
+# ========== 过期模拟器 ==========
+
+SIMULATED_ROLES = [(9001, '周会员', 7, 0.5), (9002, '月会员', 30, 0.35), (9003, '季会员', 90, 0.15)]  # (身份组ID, 名称, 天数, 占比)
+SIMULATED_VIP_ROLE_ID = 9000
+
+# 内存中的服务器替身：记录成员持有的身份组，统计撤销接口调用次数
+class SimulatedGuild:
+    def __init__(self):
+        self.members = {}
+        self.api_calls = 0
+
+    async def revoke(self, user_id, role_id):
+        self.api_calls += 1
+        roles = self.members.get(user_id)
+        if roles is None:
+            return 'left'
+        if role_id not in roles:
+            return 'absent'
+        roles.discard(role_id)
+        return 'removed'
+
+    async def restore(self, user_id, role_id):
+        self.api_calls += 1
+        if user_id in self.members:
+            self.members[user_id].add(role_id)
+
+# 按 SQL 语句类型统计数据库读写次数
+class QueryCounter:
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+
+    def __call__(self, statement):
+        verb = statement.lstrip().split(None, 1)[0].upper()
+        if verb == 'SELECT':
+            self.reads += 1
+        elif verb in ('INSERT', 'UPDATE', 'DELETE'):
+            self.writes += 1
+
+# 生成模拟数据：体验的开始时间均匀分布在过去 history_days 天到模拟结束之间（模拟开始前到期的视为已处理），
+# 手动赋予的身份组尚未到期，到期时间在各自时长内均匀分布
+def load_simulated_records(guild, start, records, hours, history_days, trial_share, left_rate, rng):
+    duration = timedelta(hours=CONFIG.experience_duration_hours)
+    window = (timedelta(days=history_days) + timedelta(hours=hours)).total_seconds()
+    trials = int(records * trial_share)
+    weights = [share for _, _, _, share in SIMULATED_ROLES]
+
+    def trial_rows():
+        for i in range(trials):
+            user_id = 10**17 + i
+            started = start - timedelta(days=history_days) + timedelta(seconds=rng.random() * window)
+            if rng.random() >= left_rate:
+                guild.members[user_id] = {SIMULATED_VIP_ROLE_ID}
+            yield user_id, started.isoformat(), 1
+
+    def grant_rows():
+        for i in range(records - trials):
+            user_id = 2 * 10**17 + i
+            role_id, _, days, _ = rng.choices(SIMULATED_ROLES, weights)[0]
+            end_time = start + timedelta(seconds=rng.random() * days * 86400)
+            if rng.random() >= left_rate:
+                guild.members[user_id] = {role_id}
+            yield user_id, role_id, (end_time - timedelta(days=days)).isoformat(), end_time.isoformat(), days
+
+    conn = get_db()
+    c = conn.cursor()
+    c.executemany('INSERT INTO role_configs (role_id, role_name, duration_days, created_at) VALUES (?, ?, ?, ?)',
+                  [(role_id, name, days, start.isoformat()) for role_id, name, days, _ in SIMULATED_ROLES])
+    c.executemany('INSERT INTO user_experience (user_id, start_time, used) VALUES (?, ?, ?)', trial_rows())
+    c.executemany('''
+        INSERT INTO user_roles (user_id, role_id, start_time, end_time, duration_days)
+        VALUES (?, ?, ?, ?, ?)
+    ''', grant_rows())
+    # 模拟开始前已处理过的体验不再重复扫描
+    set_state(c, 'experience_watermark', (start - duration).isoformat())
+    conn.commit()
+    conn.close()
+
+# 在虚拟时间上按定时任务的间隔反复执行真实的过期处理，按模拟小时汇总开销
+async def simulate_expiry(guild, sim_clock, hours, step, workers, counter):
+    results = []
+    steps_per_hour = int(timedelta(hours=1) / step)
+    for hour in range(hours):
+        totals = {'hour': hour + 1, 'enqueued': 0, 'stats': {}, 'cpu': 0.0}
+        reads, writes, api_calls = counter.reads, counter.writes, guild.api_calls
+        for _ in range(steps_per_hour):
+            sim_clock.advance(step)
+            cpu_started = time.process_time()
+            enqueued, stats = await run_expiry_sweep(guild, workers=workers)
+            totals['cpu'] += time.process_time() - cpu_started
+            totals['enqueued'] += enqueued
+            for outcome, count in stats.items():
+                totals['stats'][outcome] = totals['stats'].get(outcome, 0) + count
+        totals['reads'] = counter.reads - reads
+        totals['writes'] = counter.writes - writes
+        totals['api_calls'] = guild.api_calls - api_calls
+        results.append(totals)
+        print(f'第 {hour + 1:>3} 小时：新增 {totals["enqueued"]} 个任务（{format_revocation_stats(totals["stats"])}），'
+              f'CPU {totals["cpu"]:.2f}s，数据库读 {totals["reads"]} 次、写 {totals["writes"]} 次，'
+              f'撤销接口调用 {totals["api_calls"]} 次')
+    return results
+
+# 命令行模拟入口：在临时数据库上用虚拟时钟快进，运行真实的过期处理流程
+def run_simulate(args):
+    global DB_PATH, CONFIG, clock, _db_trace
+    rng = random.Random(args.seed)
+    db_dir = None
+    if args.db:
+        DB_PATH = args.db
     else:
-        await interaction.followup.send(embed=pages[0], ephemeral=True)
+        db_dir = tempfile.mkdtemp(prefix='vip-sim-')
+        DB_PATH = os.path.join(db_dir, 'simulate.db')
+    CONFIG = CONFIG_DEFAULTS._replace(guild_id=1, vip_role_id=SIMULATED_VIP_ROLE_ID)
+    sim_clock = SimulatedClock(datetime(2024, 1, 1))
+    clock = sim_clock
+    init_db()
+
+    guild = SimulatedGuild()
+    started = time.perf_counter()
+    load_simulated_records(guild, sim_clock.now(), args.records, args.hours, args.history_days,
+                           args.trial_share, args.left_rate, rng)
+    print(f'已生成 {args.records} 条记录（体验占 {args.trial_share:.0%}），耗时 {time.perf_counter() - started:.1f}s，'
+          f'数据库：{DB_PATH}')
+
+    counter = QueryCounter()
+    _db_trace = counter
+    step = timedelta(minutes=args.step_minutes)
+    started = time.perf_counter()
+    results = asyncio.run(simulate_expiry(guild, sim_clock, args.hours, step, args.workers, counter))
+    _db_trace = None
+
+    hours = len(results) or 1
+    print(f'模拟 {args.hours} 小时（每 {args.step_minutes:g} 分钟检查一次）用时 {time.perf_counter() - started:.1f}s，平均每小时：'
+          f'CPU {sum(r["cpu"] for r in results) / hours:.2f}s，'
+          f'数据库读 {sum(r["reads"] for r in results) / hours:.0f} 次、写 {sum(r["writes"] for r in results) / hours:.0f} 次，'
+          f'撤销接口调用 {sum(r["api_calls"] for r in results) / hours:.0f} 次')
+    if db_dir:
+        os.remove(DB_PATH)
+        os.rmdir(db_dir)
+
+# 命令行压测入口
+def run_bench_ack(args):
+    print(f'注入延迟：接口 {args.rest_latency}s，磁盘 {args.disk_latency}s（阻塞），往返 {args.rtt}s；'
+          f'{args.count} 个交互，每秒 {args.rate} 个')
+    for mode in ('inline', 'fast-ack'):
+        result = asyncio.run(bench_interactions(
+            mode, args.count, args.rate, args.rest_latency, args.disk_latency, args.rtt, args.seed))
+        print(f'{result["mode"]:>8}: 过期率 {result["expired_rate"]:.1%}，'
+              f'应答 p50 {result["ack_p50"]:.3f}s / p99 {result["ack_p99"]:.3f}s，'
+              f'完成 p50 {result["done_p50"]:.3f}s')
 
 # 运行机器人
-if __name__ == '__main__':
+def run_bot(args):
+    init_db()
+    load_config()
     if not TOKEN:
         print('错误：请在 .env 文件中设置 DISCORD_TOKEN')
-    elif not GUILD_ID or not VIP_ROLE_ID:
+    elif not CONFIG.guild_id or not CONFIG.vip_role_id:
         print('错误：请在 .env 文件中设置 GUILD_ID 和 VIP_ROLE_ID')
     else:
         bot.run(TOKEN)
 
+# 独立的撤销进程：只登录 HTTP 客户端，不连接网关，不缓存成员
+async def expire_worker(args):
+    client = discord.Client(intents=discord.Intents.none())
+    await client.login(TOKEN)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    print(f'expire-worker 已启动（{WORKER_ID}），每 {args.interval} 秒检查一次')
+    try:
+        while not stop.is_set():
+            try:
+                # 机器人修改的配置写在数据库中，每轮重新读取
+                load_config()
+                revoker = RestRevoker(client.http, CONFIG.guild_id)
+                enqueued, stats = await run_expiry_sweep(revoker, workers=args.workers)
+                if enqueued or stats:
+                    print(f'[expire-worker] 新增 {enqueued} 个撤销任务，执行结果：{format_revocation_stats(stats)}')
+            except Exception as e:
+                print(f'expire-worker 检查过期权限时出错：{str(e)}')
+            if args.once:
+                break
+            try:
+                await asyncio.wait_for(stop.wait(), args.interval)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        await client.close()
+        print('expire-worker 已退出')
+
+def run_expire_worker(args):
+    init_db()
+    load_config()
+    if not TOKEN:
+        print('错误：请在 .env 文件中设置 DISCORD_TOKEN')
+    elif not CONFIG.guild_id or not CONFIG.vip_role_id:
+        print('错误：请在 .env 文件中设置 GUILD_ID 和 VIP_ROLE_ID')
+    else:
+        asyncio.run(expire_worker(args))
+
+# 命令行导出
+def run_export(args):
+    init_db()
+    out_path, row_count = export_table(args.table, args.format, args.out, args.batch_size)
+    print(f'✅ 已导出 {args.table} 共 {row_count} 行到 {out_path}')
+
+def run_restore(args):
+    try:
+        previous = restore_database(args.backup)
+    except RuntimeError as e:
+        print(f'❌ {str(e)}')
+        sys.exit(1)
+    result = check_database_integrity(DB_PATH)
+    if previous:
+        print(f'原数据库已保留为 {previous}')
+    print(f'✅ 已从 {args.backup} 恢复数据库，完整性检查：{result}')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Discord 体验会员机器人')
+    subparsers = parser.add_subparsers(dest='command')
+    parser.set_defaults(func=run_bot)
+
+    export_parser = subparsers.add_parser('export', help='导出数据表（流式读取）')
+    export_parser.add_argument('table', choices=EXPORT_TABLES)
+    export_parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    export_parser.add_argument('--out', default=None, help='输出文件路径（默认写入 exports/ 目录）')
+    export_parser.add_argument('--batch-size', type=int, default=EXPORT_BATCH_SIZE)
+    export_parser.set_defaults(func=run_export)
+
+    worker_parser = subparsers.add_parser('expire-worker', help='独立运行撤销进程（仅使用 HTTP 接口）')
+    worker_parser.add_argument('--interval', type=float, default=60.0, help='检查间隔（秒）')
+    worker_parser.add_argument('--workers', type=int, default=4, help='并发执行撤销的数量')
+    worker_parser.add_argument('--once', action='store_true', help='只执行一轮后退出')
+    worker_parser.set_defaults(func=run_expire_worker)
+
+    bench_ack_parser = subparsers.add_parser('bench-ack', help='压测交互应答：注入延迟后对比过期率')
+    bench_ack_parser.add_argument('--count', type=int, default=300)
+    bench_ack_parser.add_argument('--rate', type=float, default=20.0, help='每秒到达的交互数')
+    bench_ack_parser.add_argument('--rest-latency', type=float, default=1.5, help='add_roles 等接口调用的中位延迟（秒）')
+    bench_ack_parser.add_argument('--disk-latency', type=float, default=0.05, help='数据库写入的中位延迟（秒）')
+    bench_ack_parser.add_argument('--rtt', type=float, default=0.1, help='应答请求本身的往返时间（秒）')
+    bench_ack_parser.add_argument('--seed', type=int, default=0)
+    bench_ack_parser.set_defaults(func=run_bench_ack)
+
+    bench_cache_parser = subparsers.add_parser('bench-member-cache', help='压测成员缓存：对比全量与选择性缓存的内存占用')
+    bench_cache_parser.add_argument('--members', type=int, default=200000)
+    bench_cache_parser.add_argument('--tracked', type=int, default=2000, help='持有相关身份组的成员数')
+    bench_cache_parser.set_defaults(func=run_bench_member_cache)
+
+    restore_parser = subparsers.add_parser('restore', help='校验快照并恢复数据库（需先停止机器人）')
+    restore_parser.add_argument('backup', help='快照文件路径（backups/ 目录中）')
+    restore_parser.set_defaults(func=run_restore)
+
+    simulate_parser = subparsers.add_parser('simulate', help='用虚拟时钟在临时数据库上模拟过期处理并统计开销')
+    simulate_parser.add_argument('--records', type=int, default=1000000, help='体验和手动赋予记录的总数')
+    simulate_parser.add_argument('--hours', type=int, default=24, help='模拟的小时数')
+    simulate_parser.add_argument('--step-minutes', type=float, default=1, help='过期检查间隔（分钟）')
+    simulate_parser.add_argument('--history-days', type=float, default=30, help='体验记录覆盖的历史天数')
+    simulate_parser.add_argument('--trial-share', type=float, default=0.5, help='体验记录占比')
+    simulate_parser.add_argument('--left-rate', type=float, default=0.02, help='已离开服务器的用户占比')
+    simulate_parser.add_argument('--workers', type=int, default=4)
+    simulate_parser.add_argument('--seed', type=int, default=0)
+    simulate_parser.add_argument('--db', default=None, help='模拟数据库路径（默认使用临时文件）')
+    simulate_parser.set_defaults(func=run_simulate)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
+